@@ -5,11 +5,40 @@ import subprocess
 import sys
 import os
 import json
-import re
 import hashlib
 import datetime
 import logging
 import fcntl
+import stat
+import selectors
+import struct
+import ctypes
+import heapq
+import itertools
+import errno
+import socket
+import random
+import threading
+import contextlib
+import shutil
+import types
+import traceback
+import http.client
+import urllib.parse
+import gzip
+import queue
+import collections
+import logging.handlers
+import sqlite3
+import zlib
+import resource
+import pwd
+import cProfile
+import pstats
+import tracemalloc
+import faulthandler
+import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # This file must be able to run on its own without any additional python dependencies.
 # When the system starts up, this file copies itself to a different directory, creates
@@ -26,16 +55,93 @@ import fcntl
 #     program is killed. This prevents you from cheating by changing the configurations.
 
 
-LOAD_PLIST_CMD = "sudo launchctl load /Library/LaunchDaemons/com.example.{name}.plist"
+PLIST_DIR = "/Library/LaunchDaemons/"
+LOAD_PLIST_CMD = "sudo launchctl load {plist}"
+SYSTEMD_DIR = "/etc/systemd/system/"
 WORKING_DIR = "/tmp/annoying_scheduler/"
 
-IN_PIPE = os.path.join(WORKING_DIR, "comms_in.pipe")
-OUT_PIPE = os.path.join(WORKING_DIR, "comms_out.pipe")
+COMMAND_SOCKET = os.path.join(WORKING_DIR, "comms.sock")
+HANDOFF_SOCKET = os.path.join(WORKING_DIR, "handoff.sock")
 CONFIG_FILE = os.path.join(WORKING_DIR, "config.json")
+JOURNAL_FILE = os.path.join(WORKING_DIR, "state.journal")
+BLOB_DIR = os.path.join(WORKING_DIR, "blobs")
 HOSTS_FILE = "/etc/hosts"
 KILLSWITCH = os.path.join(WORKING_DIR, "killswitch")
 LOCK_FILE = os.path.join(WORKING_DIR, "process.lock")
 
+# A new instance waits up to LOCK_TIMEOUT seconds for the old one to give up the lock,
+# checking every LOCK_POLL_INTERVAL seconds. An instance that is replacing itself waits
+# up to HANDOFF_TIMEOUT seconds to hand its lock straight to the new one.
+LOCK_TIMEOUT = 30
+LOCK_POLL_INTERVAL = 0.05
+HANDOFF_TIMEOUT = 10
+
+# Exit code of a supervised worker that was killed and wants to be started again. It
+# exits with 0 only if it was allowed to stop.
+RESPAWN_EXIT_CODE = 75
+
+# How often (in seconds) the hosts file and managed files are checked, and how often the
+# in-memory state is written back to disk.
+ENFORCE_INTERVAL = 5
+PERSIST_INTERVAL = 60
+
+# Condition scripts are run in parallel on this many threads. Each script is killed if
+# it runs longer than its timeout.
+MAX_CONDITION_WORKERS = 8
+DEFAULT_CONDITION_TIMEOUT = 60
+
+# Limits for condition scripts, unless their config says otherwise. Scripts get as much
+# CPU time as their timeout, and whatever they print past MAX_SCRIPT_OUTPUT bytes (on
+# stdout and stderr each) is thrown away.
+DEFAULT_OPEN_FILES_LIMIT = 256
+MAX_SCRIPT_OUTPUT = 1024 * 1024
+
+# How often the metrics are written out in the Prometheus textfile format.
+METRICS_INTERVAL = 60
+METRICS_FILE = os.path.join(WORKING_DIR, "metrics.prom")
+
+# Every condition run is recorded here, for streaks and stats.
+HISTORY_FILE = os.path.join(WORKING_DIR, "history.db")
+
+# Changes to the config are appended to JOURNAL_FILE, which is folded into a new
+# CONFIG_FILE once it grows past this many bytes.
+JOURNAL_MAX_BYTES = 256 * 1024
+
+# The daemon's log is rotated once it reaches LOG_MAX_BYTES, and LOG_BACKUPS compressed
+# old logs are kept. The last LOG_RING_SIZE lines are also kept in memory for the 'logs'
+# command. A message is only logged LOG_BURST times every LOG_WINDOW seconds.
+LOG_FILE = os.path.join(WORKING_DIR, "daemon.log")
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+LOG_RING_SIZE = 1000
+LOG_BURST = 5
+LOG_WINDOW = 60
+
+# 'digital-carrot profile' and SIGUSR1 profile the daemon for a while and write the
+# results to PROFILE_DIR, which keeps the last PROFILE_KEEP of them. SIGUSR2 dumps the
+# stack of every thread to STACKS_FILE, even if the daemon is stuck.
+PROFILE_DIR = os.path.join(WORKING_DIR, "profiles")
+STACKS_FILE = os.path.join(WORKING_DIR, "stacks.log")
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 600
+PROFILE_KEEP = 10
+PROFILE_TOP = 50
+
+# Script results are cached. Successes are kept until the day rolls over (or for the
+# condition's cache_ttl if it is shorter), failures only for failure_cache_ttl seconds.
+DEFAULT_FAILURE_CACHE_TTL = 30
+
+# Conditions with a check_interval are run in the background until they are met. Each
+# check is moved by up to CHECK_JITTER of the interval so that they don't all line up,
+# and checks that error out back off, doubling the wait up to MAX_CHECK_BACKOFF seconds.
+CHECK_JITTER = 0.1
+MAX_CHECK_BACKOFF = 3600
+
+# How often the sync server (sync_url in the config) is polled for new restrictions, and
+# how long a poll may take.
+DEFAULT_SYNC_INTERVAL = 300
+SYNC_TIMEOUT = 60
+
 PLIST = """<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
 <plist version="1.0">
@@ -65,16 +171,30 @@ PLIST = """<?xml version="1.0" encoding="UTF-8"?>
     <string>{log_path}</string>
     <key>StandardErrorPath</key>
     <string>{log_path}</string>
-
-    <key>EnvironmentVariables</key>
-    <dict>
-        <key>PYTHONUNBUFFERED</key>
-        <string>true</string>
-    </dict>
 </dict>
 </plist>
 """
 
+SYSTEMD_UNIT = """[Unit]
+Description=Digital Carrot ({name})
+After=network.target
+
+[Service]
+ExecStart={file} {name}
+# Come straight back up if we are killed. We only exit cleanly once a replacement has
+# taken over (or we were disabled), and then this unit is done.
+Restart=always
+RestartPreventExitStatus=0
+RestartSec=0
+# Only signal the daemon itself, so that it gets a chance to replace itself.
+KillMode=process
+StandardOutput=append:{log_path}
+StandardError=append:{log_path}
+
+[Install]
+WantedBy=multi-user.target
+"""
+
 WEEKDAYS = {
     0: "mon",
     1: "tue",
@@ -87,31 +207,348 @@ WEEKDAYS = {
 
 logger = logging.getLogger(__file__.split("/")[-1])
 logger.setLevel(logging.INFO)
+
+
 formatter = logging.Formatter('%(name)s: %(asctime)s - %(levelname)s - %(message)s')
 
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
 
-stderr_handler = logging.StreamHandler(sys.stderr)
-stderr_handler.setLevel(logging.ERROR)
-stderr_handler.setFormatter(formatter)
+# Lets through the first LOG_BURST copies of a message in every LOG_WINDOW seconds. The
+# first one let through after that says how many were dropped.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, burst=LOG_BURST, window=LOG_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.lock = threading.Lock()
+        # (level, message) -> [start of the current window, messages seen in it]
+        self.seen = {}
+
+    def filter(self, record):
+        key = (record.levelno, record.getMessage())
+        now = time.monotonic()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                return entry[1] <= self.burst
+
+            if entry is not None and entry[1] > self.burst:
+                record.msg = f"{key[1]} ({entry[1] - self.burst} more like this were dropped)"
+                record.args = None
+            self.seen[key] = [now, 1]
+
+            # Forget about messages that haven't been seen for a while, or about all of
+            # them if there are just too many different ones.
+            if len(self.seen) > 10 * LOG_RING_SIZE:
+                self.seen = {k: v for k, v in self.seen.items() if now - v[0] < self.window}
+                if len(self.seen) > 5 * LOG_RING_SIZE:
+                    self.seen = {}
+        return True
+
+
+# Writes to the log file through Python's own buffer instead of flushing every record.
+# Warnings and errors are written straight away, everything else when sync() is called
+# or the buffer fills up.
+class BufferedLogHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = compress_log
+
+    def emit(self, record):
+        super().emit(record)
+        if record.levelno >= logging.WARNING:
+            self.sync()
+
+    # Called by StreamHandler after every record, which is what we want to avoid.
+    def flush(self):
+        pass
+
+    def sync(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.sync()
+        super().close()
+
+
+def compress_log(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+# The most recent log lines, for the 'logs' command.
+class RecentLogs(logging.Handler):
+    def __init__(self, capacity=LOG_RING_SIZE):
+        super().__init__()
+        self.lines = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+    def tail(self, count=None):
+        self.acquire()
+        try:
+            lines = list(self.lines)
+        finally:
+            self.release()
+        return lines[-count:] if count else lines
+
+
+recent_logs = RecentLogs()
+recent_logs.setFormatter(formatter)
+
+
+# The queue never leaves this process, so records don't need to be formatted and copied
+# before they are put on it. That's left to the writer thread.
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
 
-# Add the handlers to the logger
-logger.addHandler(stdout_handler)
-logger.addHandler(stderr_handler)
 
+# The daemon logs through a queue. Records are formatted and written on a background
+# thread, so the event loop never waits on the disk.
+class LogWriter():
+    def __init__(self, path):
+        self.file = BufferedLogHandler(path)
+        self.file.setFormatter(formatter)
+        self.queue = queue.SimpleQueue()
+        self.handler = LocalQueueHandler(self.queue)
+        self.handler.addFilter(RateLimitFilter())
+        self.listener = logging.handlers.QueueListener(self.queue, self.file, recent_logs)
+        self.listener.start()
+
+    def sync(self):
+        self.file.sync()
+
+    # Write out everything that's still queued.
+    def close(self):
+        self.listener.stop()
+        self.file.close()
+
+
+log_writer = None
+
+
+# Handlers are only added by whatever is actually going to run the scheduler, so that
+# importing this module stays cheap and quiet. Without a log file, records go to stderr.
+# This is also called again in forked workers, where the parent's writer thread doesn't
+# exist.
+def setup_logging(log_file=None):
+    global log_writer
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    log_writer = None
+
+    if log_file is None:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        return
+
+    log_writer = LogWriter(log_file)
+    logger.addHandler(log_writer.handler)
+
+
+def sync_logs():
+    if log_writer is not None:
+        log_writer.sync()
+
+
+def close_logs():
+    if log_writer is not None:
+        log_writer.close()
+
+
+# Counters and latency histograms, keyed by name and labels. These are rendered in the
+# Prometheus text format for the 'stats' command and the textfile exporter.
+class Metrics():
+    BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            if (histogram := self.histograms.get(key)) is None:
+                histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0, 0]
+            for i, bucket in enumerate(self.BUCKETS):
+                if value <= bucket:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.gauges}):
+                lines.append(f"# TYPE {name} gauge")
+                for (metric, labels), value in sorted(self.gauges.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bucket, value in zip(self.BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bucket)),))} {value}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+metrics = Metrics()
+
+
+# Take the lock that makes sure only one instance is enforcing at a time. An instance
+# that is replacing itself hands its lock straight over on HANDOFF_SOCKET, otherwise we
+# wait for it to be released. Returns the locked file, or None if we timed out.
+def acquire_lock(timeout=LOCK_TIMEOUT):
+    lockfile = open(LOCK_FILE, "a")
+    deadline = time.monotonic() + timeout
+    waiting = False
+    while True:
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lockfile
+        except BlockingIOError:
+            pass
+
+        if (fd := receive_lock()) is not None:
+            lockfile.close()
+            logger.info("lock was handed over")
+            return os.fdopen(fd, "a")
+
+        if time.monotonic() > deadline:
+            lockfile.close()
+            return None
+        if not waiting:
+            logger.info("waiting for lock")
+            waiting = True
+        time.sleep(LOCK_POLL_INTERVAL)
 
-def is_file_locked(filepath):
+
+# flock() locks belong to the open file, not the process, so receiving a descriptor for
+# the locked file means we hold the lock too. It stays held once the sender closes theirs.
+def receive_lock():
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(HANDOFF_SOCKET)
+            sock.settimeout(HANDOFF_TIMEOUT)
+            _, fds, _, _ = socket.recv_fds(sock, 16, 1)
+        except OSError:
+            return None
+
+    if not fds:
+        return None
+    # Make sure that we were actually sent the lock file.
+    lock_stat = os.fstat(fds[0])
     try:
-        with open(filepath, "w") as f:
-            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            fcntl.flock(f, fcntl.LOCK_UN)
-            return False
-    except (BlockingIOError, PermissionError):
-        return True
+        expected = os.stat(LOCK_FILE)
+        if (lock_stat.st_dev, lock_stat.st_ino) == (expected.st_dev, expected.st_ino):
+            return fds[0]
     except FileNotFoundError:
-        return False
+        pass
+    os.close(fds[0])
+    return None
+
+
+# Wait for the instance that replaces us to pick up our lock, calling tick() every
+# LOCK_POLL_INTERVAL seconds in the meantime so that we keep enforcing until it has
+# started. Returns False if nobody asked for it in time, in which case it is simply
+# released.
+def hand_off_lock(lockfile, tick=None, timeout=HANDOFF_TIMEOUT):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(HANDOFF_SOCKET)
+
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(HANDOFF_SOCKET)
+        try:
+            os.chmod(HANDOFF_SOCKET, 0o600)
+            server.listen(1)
+            server.settimeout(LOCK_POLL_INTERVAL)
+            while True:
+                try:
+                    conn, _ = server.accept()
+                    break
+                except socket.timeout:
+                    if time.monotonic() > deadline:
+                        return False
+                    if tick is not None:
+                        tick()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(HANDOFF_SOCKET)
+
+    with conn:
+        socket.send_fds(conn, [b"lock"], [lockfile.fileno()])
+    return True
+
+
+def read_config():
+    with open(CONFIG_FILE, "r") as f:
+        return json.loads(f.read())
+
+
+# How the daemon keeps itself running: a launchd plist on MacOS, a systemd unit on Linux
+# or, where there is no systemd, a supervisor process of our own.
+def service_backend(config):
+    backend = config.get("service_backend", "auto")
+    if backend != "auto":
+        return backend
+    if sys.platform == "darwin":
+        return "launchd"
+    if os.path.isdir("/run/systemd/system"):
+        return "systemd"
+    return "supervisor"
 
 
 def file_hash(filepath):
@@ -131,32 +568,1875 @@ def hash(string):
     return m.hexdigest()
 
 
-def from_now(days=1, hour=2):
-    future = datetime.datetime.today() + datetime.timedelta(days=days)
+# The current stack of every thread, most recent call last.
+def thread_stacks():
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        stacks.append(f"Thread {names.get(ident, ident)}:\n" + "".join(traceback.format_stack(frame)))
+    return "\n".join(stacks)
+
+
+# Profiles the daemon for a while: cProfile for where the loop spends its time (the
+# executor's threads mostly wait on scripts), and tracemalloc for what allocated the
+# memory that is still held at the end.
+class Profiler():
+    def __init__(self):
+        self.profile = None
+        self.tracing = False
+
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        # Leave tracemalloc alone if somebody else started it.
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.tracing = True
+
+    # Write the results to PROFILE_DIR and return the paths of the files written.
+    def stop(self):
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+        snapshot = tracemalloc.take_snapshot()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        prefix = os.path.join(PROFILE_DIR, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+        profile.dump_stats(prefix + ".pstats")
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        with open(prefix + "-profile.txt", "w") as f:
+            f.write(summary.getvalue())
+
+        with open(prefix + "-allocations.txt", "w") as f:
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+                f.write(f"{stat}\n")
+
+        # Every profile is three files, whose names start with when it was taken.
+        for old in sorted(os.listdir(PROFILE_DIR))[:-PROFILE_KEEP * 3]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(PROFILE_DIR, old))
+        return [prefix + ".pstats", prefix + "-profile.txt", prefix + "-allocations.txt"]
+
+
+# The parts of a stat result that change whenever a file is rewritten, replaced or
+# chmod-ed. ctime can't be forged from userspace, so a touch won't hide an edit.
+def stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_mode)
+
+
+# Where the daemon gets the time of day from. The simulator in
+# digital_carrot.benchmarks.simulate passes in its own, to play through weeks in seconds.
+class Clock():
+    def now(self):
+        return datetime.datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+SYSTEM_CLOCK = Clock()
+
+
+def from_now(days=1, hour=2, clock=SYSTEM_CLOCK):
+    future = clock.now() + datetime.timedelta(days=days)
     future = future.replace(hour=hour, minute=0, second=0, microsecond=0)
     return future.isoformat()
 
+
+HOSTS_BLOCK_START = "#fitblock"
+HOSTS_BLOCK_END = "#/fitblock"
+
+
+# Stream a hosts file line by line. Yields (in_block, line) where in_block is True for
+# lines inside our block, False for everything else and None for the block markers.
+# Lines keep their line endings.
+def scan_hosts(f):
+    in_block = False
+    for line in f:
+        stripped = line.rstrip("\r\n")
+        if not in_block and stripped.endswith(HOSTS_BLOCK_START):
+            # Older versions appended the block without making sure the file ended
+            # with a newline, so the marker can share a line with a real entry.
+            if prefix := stripped[:-len(HOSTS_BLOCK_START)]:
+                yield False, prefix + "\n"
+            in_block = True
+            yield None, line
+        elif in_block and stripped.endswith(HOSTS_BLOCK_END):
+            in_block = False
+            yield None, line
+        else:
+            yield in_block, line
+
+
+def open_hosts(path, mode="r"):
+    return open(path, mode, encoding="utf-8", errors="surrogateescape", newline="")
+
+
+# A hosts file that was deleted reads as an empty one, so that it gets written again.
+def read_hosts(path):
+    try:
+        return open_hosts(path)
+    except FileNotFoundError:
+        return io.StringIO()
+
+
+# Make sure the hosts file contains exactly one block with the given entries, or no
+# block at all if entries is None. The file is only written if it needs to change, and
+# is replaced atomically when it does. Returns the sha of the resulting file.
+def patch_hosts(path, entries):
+    path = os.path.realpath(path)
+    wanted = [] if entries is None else list(entries)
+
+    sha = hashlib.sha256()
+    blocks = 0
+    found = []
+    with read_hosts(path) as f:
+        for in_block, line in scan_hosts(f):
+            sha.update(line.encode("utf-8", "surrogateescape"))
+            if in_block is None:
+                blocks += line.rstrip("\r\n").endswith(HOSTS_BLOCK_START)
+            elif in_block and line.strip():
+                found.append(line.strip())
+
+    if blocks == (0 if entries is None else 1) and found == wanted:
+        return sha.hexdigest()
+
+    sha = hashlib.sha256()
+    tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".digital_carrot")
+    with read_hosts(path) as src, open_hosts(tmp, "w") as dst:
+        def write(line):
+            sha.update(line.encode("utf-8", "surrogateescape"))
+            dst.write(line)
+
+        last = "\n"
+        for in_block, line in scan_hosts(src):
+            if in_block is False:
+                write(line)
+                last = line
+
+        if entries is not None:
+            if not last.endswith("\n"):
+                write("\n")
+            write(HOSTS_BLOCK_START + "\n")
+            for entry in wanted:
+                write(entry + "\n")
+            write(HOSTS_BLOCK_END + "\n")
+
+        dst.flush()
+        os.fsync(dst.fileno())
+
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    os.chmod(tmp, 0o644 if st is None else stat.S_IMODE(st.st_mode))
+    try:
+        if st is not None:
+            os.chown(tmp, st.st_uid, st.st_gid)
+        os.replace(tmp, path)
+    except OSError:
+        # Some hosts files can't be replaced (eg. when bind mounted into a container),
+        # so fall back to copying over the top of them.
+        with open_hosts(tmp) as src, open_hosts(path, "w") as dst:
+            for line in src:
+                dst.write(line)
+        os.remove(tmp)
+
+    return sha.hexdigest()
+
+
+# The outcome of running a condition script.
+# cpu is the CPU time the script used in seconds, max_rss its peak memory use in bytes,
+# and truncated is set if some of its output had to be thrown away.
+class ScriptResult():
+    def __init__(self, returncode, stdout="", stderr="", timed_out=False, duration=0, cpu=0, max_rss=0,
+                 truncated=False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.duration = duration
+        self.cpu = cpu
+        self.max_rss = max_rss
+        self.truncated = truncated
+
+
+# What a condition script is allowed to do: the user it runs as (if we're root) and the
+# limits on its CPU time in seconds, address space in bytes, open files and output.
+class Sandbox():
+    def __init__(self, user=None, uid=None, gid=None, groups=None, home=None, cpu=None, memory=None,
+                 open_files=DEFAULT_OPEN_FILES_LIMIT, output=MAX_SCRIPT_OUTPUT):
+        self.user = user
+        self.uid = uid
+        self.gid = gid
+        self.groups = groups
+        self.home = home
+        self.cpu = cpu
+        self.memory = memory
+        self.open_files = open_files
+        self.output = output
+
+    # Look up the user to run as. Raises KeyError if they don't exist.
+    def run_as(self, user):
+        if user is None or os.geteuid() != 0:
+            return
+        pw = pwd.getpwnam(user)
+        self.user = user
+        self.uid = pw.pw_uid
+        self.gid = pw.pw_gid
+        self.groups = os.getgrouplist(user, pw.pw_gid)
+        self.home = pw.pw_dir
+
+    def env(self):
+        if self.user is None:
+            return None
+        return {**os.environ, "HOME": self.home, "USER": self.user, "LOGNAME": self.user}
+
+    # The command that runs cmd with our limits. They're set by a shell that then execs
+    # the script, since setting them between fork and exec would stop subprocess from
+    # using vfork, which gets slower the bigger the daemon gets.
+    def command(self, cmd):
+        limits = []
+        if self.cpu:
+            limits.append(f"ulimit -t {int(self.cpu)}")
+        if self.memory:
+            limits.append(f"ulimit -v {self.memory // 1024}")
+        if self.open_files:
+            limits.append(f"ulimit -n {self.open_files}")
+        if not limits:
+            return cmd
+        script = "".join(f"{limit} 2>/dev/null; " for limit in limits) + 'exec "$0" "$@"'
+        return ["/bin/sh", "-c", script, *cmd]
+
+    # Sets the limits on this process, for forks that don't go through a shell. Limits
+    # that the system doesn't support are skipped.
+    def limit(self):
+        limits = [
+            (resource.RLIMIT_CPU, self.cpu and (self.cpu, self.cpu + 1)),
+            (resource.RLIMIT_AS, self.memory and (self.memory, self.memory)),
+            (resource.RLIMIT_NOFILE, self.open_files and (self.open_files, self.open_files)),
+        ]
+        for which, limit in limits:
+            if not limit:
+                continue
+            try:
+                resource.setrlimit(which, limit)
+            except (ValueError, OSError):
+                pass
+
+    # Also for forks that don't go through subprocess, which does this itself.
+    def drop_privileges(self):
+        if self.uid is None:
+            return
+        os.setgroups(self.groups)
+        os.setgid(self.gid)
+        os.setuid(self.uid)
+
+
+# Keeps the first limit bytes written to each pipe. The rest is still read, so that the
+# script doesn't block on a full pipe, but thrown away.
+class CappedOutput():
+    def __init__(self, fds, limit):
+        self.limit = limit
+        self.data = {fd: bytearray() for fd in fds}
+        self.dropped = 0
+
+    # Returns False once the pipe is closed.
+    def read(self, fd):
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return False
+        data = self.data[fd]
+        keep = max(0, self.limit - len(data))
+        data += chunk[:keep]
+        self.dropped += max(0, len(chunk) - keep)
+        return True
+
+    def text(self, fd):
+        return self.data[fd].decode("utf-8", "replace").strip()
+
+
+# CPU time in seconds and peak memory in bytes, which MacOS reports in bytes and
+# everything else in kilobytes.
+def rusage_stats(rusage):
+    return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+# Wait for the script to exit, killing its process group if it isn't done by the
+# deadline. Returns the exit code (None if it was killed) and its rusage.
+def reap_script(pid, deadline):
+    delay = 0.0005
+    while True:
+        reaped, status, rusage = os.wait4(pid, os.WNOHANG)
+        if reaped:
+            return os.waitstatus_to_exitcode(status), rusage
+        if time.monotonic() >= deadline:
+            kill_group(pid)
+            _, _, rusage = os.wait4(pid, 0)
+            return None, rusage
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+def kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# Run a script in its own process group, with the sandbox's user and limits. Its output
+# is read as it's written, into buffers capped at the sandbox's output limit.
+def run_script(cmd, timeout=DEFAULT_CONDITION_TIMEOUT, sandbox=None):
+    if sandbox is None:
+        sandbox = Sandbox()
+    start = time.monotonic()
+    deadline = start + timeout
+    try:
+        proc = subprocess.Popen(
+            sandbox.command(cmd),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+            user=sandbox.uid,
+            group=sandbox.gid,
+            extra_groups=sandbox.groups,
+            env=sandbox.env(),
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        if getattr(e, "errno", None) == errno.ENOEXEC:
+            msg = "Error executing script. Did you add a shebang?"
+        else:
+            msg = f"Error executing script: {e}"
+        return ScriptResult(1, stderr=msg, duration=time.monotonic() - start)
+
+    with proc:
+        out, err = proc.stdout.fileno(), proc.stderr.fileno()
+        output = CappedOutput([out, err], sandbox.output)
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(out, selectors.EVENT_READ)
+            selector.register(err, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                events = selector.select(remaining) if remaining > 0 else []
+                if not events:
+                    kill_group(proc.pid)
+                    break
+                for key, _ in events:
+                    if not output.read(key.fd):
+                        selector.unregister(key.fd)
+        finally:
+            selector.close()
+
+        code, rusage = reap_script(proc.pid, deadline)
+        if time.monotonic() >= deadline:
+            code = None
+        # We reaped it ourselves, don't let Popen try to.
+        proc.returncode = -signal.SIGKILL if code is None else code
+
+    cpu, max_rss = rusage_stats(rusage)
+    return ScriptResult(
+        code,
+        output.text(out),
+        output.text(err),
+        timed_out=code is None,
+        duration=time.monotonic() - start,
+        cpu=cpu,
+        max_rss=max_rss,
+        truncated=output.dropped > 0,
+    )
+
+
+# Returns True if the script would be run by the same python interpreter as the daemon,
+# which is what lets it run in the warm pool instead.
+def is_python_script(source):
+    if not source.startswith("#!"):
+        return False
+    interpreter = source[2:].split("\n", 1)[0].split()
+    if not interpreter:
+        return False
+    if os.path.basename(interpreter[0]) == "env" and len(interpreter) > 1:
+        found = shutil.which(interpreter[1])
+        if found is None:
+            return False
+        interpreter = [found]
+    return os.path.realpath(interpreter[0]) == os.path.realpath(sys.executable)
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+# What the zygote sends back when a script exits: its exit code, CPU time and peak memory.
+EXIT_STATUS = struct.Struct("!idq")
+
+
+# Runs python condition scripts without paying for interpreter startup and imports
+# every time. A zygote process is forked once with common modules already imported.
+# For every run it forks again, so each script gets a fresh copy of that warm process
+# with its own stdout, stderr, exit code and sandbox, just as if it had been run on its own.
+class WarmPool():
+    def __init__(self, preload=()):
+        self.lock = threading.Lock()
+        self.sock, zygote_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                self.sock.close()
+                Zygote(zygote_sock, preload).serve()
+            finally:
+                os._exit(0)
+        zygote_sock.close()
+
+    def close(self):
+        self.sock.close()
+        os.waitpid(self.pid, 0)
+
+    def run(self, cmd, source, timeout=DEFAULT_CONDITION_TIMEOUT, sandbox=None):
+        if sandbox is None:
+            sandbox = Sandbox()
+        start = time.monotonic()
+        deadline = start + timeout
+        job, zygote_job = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+
+        try:
+            request = json.dumps({
+                "path": cmd[0],
+                "args": cmd[1:],
+                "source": source,
+                "sandbox": vars(sandbox),
+            }).encode("utf-8")
+            with self.lock:
+                socket.send_fds(
+                    self.sock,
+                    [struct.pack("!I", len(request)) + request],
+                    [zygote_job.fileno(), out_w, err_w],
+                )
+        finally:
+            zygote_job.close()
+            os.close(out_w)
+            os.close(err_w)
+
+        with job:
+            pid = struct.unpack("!i", recv_exactly(job, 4))[0]
+            output = CappedOutput([out_r, err_r], sandbox.output)
+            selector = selectors.DefaultSelector()
+            try:
+                for fd in (out_r, err_r):
+                    selector.register(fd, selectors.EVENT_READ)
+                selector.register(job, selectors.EVENT_READ)
+
+                status = None
+                while status is None or selector.get_map().keys() - {job.fileno()}:
+                    remaining = deadline - time.monotonic()
+                    events = selector.select(remaining) if remaining > 0 else []
+                    if not events:
+                        kill_group(pid)
+                        return ScriptResult(None, timed_out=True, duration=time.monotonic() - start)
+                    for key, _ in events:
+                        if key.fileobj is job:
+                            status = EXIT_STATUS.unpack(recv_exactly(job, EXIT_STATUS.size))
+                            selector.unregister(job)
+                        elif not output.read(key.fd):
+                            selector.unregister(key.fd)
+            finally:
+                selector.close()
+                os.close(out_r)
+                os.close(err_r)
+
+        code, cpu, max_rss = status
+        return ScriptResult(
+            code,
+            output.text(out_r),
+            output.text(err_r),
+            duration=time.monotonic() - start,
+            cpu=cpu,
+            max_rss=max_rss,
+            truncated=output.dropped > 0,
+        )
+
+
+# The process that WarmPool forks scripts from. It only ever waits on its control
+# socket and on its children, so it stays single threaded and safe to fork.
+class Zygote():
+    def __init__(self, sock, preload):
+        self.sock = sock
+        self.jobs = {}
+
+        # Don't hold on to anything of the daemon's, especially the lock file.
+        os.closerange(3, sock.fileno())
+        os.closerange(sock.fileno() + 1, os.sysconf("SC_OPEN_MAX"))
+
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        for module in preload:
+            try:
+                __import__(module)
+            except Exception:
+                pass
+
+    def serve(self):
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        selector.register(wakeup_r, selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is self.sock:
+                    if not self.accept():
+                        # The daemon went away.
+                        return
+                else:
+                    try:
+                        while os.read(wakeup_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+            self.reap()
+
+    def accept(self):
+        data, fds, _, _ = socket.recv_fds(self.sock, 65536, 3)
+        if not data:
+            return False
+        length = struct.unpack_from("!I", data)[0]
+        data = data[4:] + recv_exactly(self.sock, length - len(data) + 4)
+        request = json.loads(data.decode("utf-8"))
+        job_fd, out_w, err_w = fds
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # Undo the zygote's own signal handling. The wakeup fd's number is about to be
+            # freed, and the script could open a file that gets it.
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.setsid()
+            os.dup2(out_w, 1)
+            os.dup2(err_w, 2)
+            os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+            try:
+                sandbox = Sandbox(**request["sandbox"])
+                sandbox.drop_privileges()
+                sandbox.limit()
+                if (env := sandbox.env()) is not None:
+                    os.environ.update(env)
+            except BaseException as e:
+                print(f"Couldn't set up the sandbox: {e}", file=sys.stderr)
+                os._exit(1)
+            os._exit(exec_python(request["path"], request["args"], request["source"]))
+
+        os.close(out_w)
+        os.close(err_w)
+        job = socket.socket(fileno=job_fd)
+        job.sendall(struct.pack("!i", pid))
+        self.jobs[pid] = job
+        return True
+
+    def reap(self):
+        while self.jobs:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if job := self.jobs.pop(pid, None):
+                try:
+                    job.sendall(EXIT_STATUS.pack(os.waitstatus_to_exitcode(status), *rusage_stats(rusage)))
+                except OSError:
+                    pass
+                job.close()
+
+
+# Run python source as __main__, the way the interpreter would run a script. Returns
+# the exit code.
+def exec_python(path, args, source):
+    sys.argv = [path] + args
+    sys.path[0] = os.path.dirname(os.path.abspath(path))
+    module = types.ModuleType("__main__")
+    module.__file__ = path
+    module.__builtins__ = __builtins__
+    sys.modules["__main__"] = module
+    code = 0
+    try:
+        exec(compile(source, path, "exec"), module.__dict__)
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException as e:
+        # Leave this function out of the traceback.
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except Exception:
+        pass
+    return code
+
+
+# A small HTTP client for the built in conditions. Connections are kept alive and
+# reused, responses are cached for their max-age (and revalidated with their ETag or
+# Last-Modified once that runs out), and concurrent requests for the same URL are
+# collapsed into one. It is shared by every condition, so several conditions that check
+# the same API only make one request.
+class HttpClient():
+    MAX_IDLE = 4
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.cache = {}
+        self.inflight = {}
+
+    # Returns (status, body). Raises OSError (or http.client.HTTPException) if the
+    # request couldn't be made.
+    def get(self, url, headers=None, timeout=DEFAULT_CONDITION_TIMEOUT):
+        headers = headers or {}
+        key = (url, tuple(sorted(headers.items())))
+        while True:
+            with self.lock:
+                cached = self.cache.get(key)
+                if cached and cached["expires"] > time.monotonic():
+                    metrics.inc("digital_carrot_http_cache_hits_total")
+                    return cached["status"], cached["body"]
+                if (event := self.inflight.get(key)) is None:
+                    event = self.inflight[key] = threading.Event()
+                    break
+            # Somebody else is already fetching this URL, wait for their response.
+            event.wait(timeout)
+
+        try:
+            return self.fetch(key, url, headers, cached, timeout)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+
+    def fetch(self, key, url, headers, cached, timeout):
+        headers = {**headers, "Connection": "keep-alive"}
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        status, response_headers, body = self.request(url, headers, timeout)
+        if status == 200:
+            entry = {
+                "max_age": cache_max_age(response_headers),
+                "etag": response_headers.get("ETag"),
+                "last_modified": response_headers.get("Last-Modified"),
+                "status": status,
+                "body": body,
+            }
+        elif status == 304 and cached:
+            # A 304 only replaces the headers that it sends, the rest are kept from the
+            # response it revalidated.
+            entry = {**cached}
+            if "Cache-Control" in response_headers:
+                entry["max_age"] = cache_max_age(response_headers)
+            entry["etag"] = response_headers.get("ETag", cached["etag"])
+            entry["last_modified"] = response_headers.get("Last-Modified", cached["last_modified"])
+            status, body = cached["status"], cached["body"]
+        else:
+            return status, body
+
+        entry["expires"] = time.monotonic() + entry["max_age"]
+        with self.lock:
+            self.cache[key] = entry
+        return status, body
+
+    def request(self, url, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        origin = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        # A kept alive connection may have been closed by the server in the meantime,
+        # so a failure on a reused connection is retried once on a fresh one.
+        for attempt in range(2):
+            conn, reused = self.checkout(origin, timeout)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            metrics.inc("digital_carrot_http_requests_total", host=parts.netloc, status=response.status)
+            if response.will_close:
+                conn.close()
+            else:
+                self.checkin(origin, conn)
+            return response.status, response.headers, body
+
+    def checkout(self, origin, timeout):
+        with self.lock:
+            if idle := self.idle.get(origin):
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, netloc = origin
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def checkin(self, origin, conn):
+        with self.lock:
+            idle = self.idle.setdefault(origin, [])
+            if len(idle) < self.MAX_IDLE:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+DEFAULT_HTTP_CACHE_TTL = 30
+
+
+def cache_max_age(headers):
+    cache_control = headers.get("Cache-Control", "")
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "max-age" and value.isdigit():
+            return int(value)
+    return DEFAULT_HTTP_CACHE_TTL
+
+
+# Follow a dotted path like "data.0.steps" into parsed JSON.
+def json_path(data, path):
+    for part in path.split(".") if path else []:
+        if isinstance(data, list):
+            data = data[int(part)]
+        else:
+            data = data[part]
+    return data
+
+
+COMPARISONS = {
+    ">=": lambda value, threshold: value >= threshold,
+    ">": lambda value, threshold: value > threshold,
+    "<=": lambda value, threshold: value <= threshold,
+    "<": lambda value, threshold: value < threshold,
+    "==": lambda value, threshold: value == threshold,
+    "!=": lambda value, threshold: value != threshold,
+}
+
+
+# Fetch JSON from "url" and compare the number at "json_path" with the threshold. The
+# threshold is the condition's first argument if it has one (so that pause_args can ask
+# for more), otherwise "threshold".
+def http_json_threshold(client, cfg, args, timeout):
+    try:
+        threshold = float(args[0]) if args else float(cfg["threshold"])
+        status, body = client.get(cfg["url"], cfg.get("headers"), timeout)
+        if status != 200:
+            return ScriptResult(1, stderr=f"{cfg['url']} returned {status}")
+        value = float(json_path(json.loads(body), cfg.get("json_path", "")))
+    except (OSError, http.client.HTTPException, ValueError, KeyError, IndexError, TypeError) as e:
+        return ScriptResult(1, stderr=f"{type(e).__name__}: {e}")
+
+    comparison = cfg.get("comparison", ">=")
+    label = cfg.get("json_path") or "value"
+    if COMPARISONS[comparison](value, threshold):
+        return ScriptResult(0, f"{label} is {value:g} ({comparison} {threshold:g})")
+    return ScriptResult(2, f"{label} is {value:g}, needs to be {comparison} {threshold:g}")
+
+
+# Settings of a built in condition that its result depends on.
+BUILTIN_SETTINGS = ("type", "url", "headers", "json_path", "threshold", "comparison")
+
+# Conditions that run inside the daemon instead of as a script, by their "type".
+BUILTIN_CONDITIONS = {
+    "http_json_threshold": http_json_threshold,
+}
+
+
+# Fleet sync. The sync server serves a manifest like
+#
+#   {"version": 42, "snapshot": {"version": 40, "url": "full-40.json"},
+#    "deltas": [{"version": 41, "url": "41.json"}, {"version": 42, "url": "42.json"}]}
+#
+# where version n's delta holds what was added between n - 1 and n, and the snapshot
+# everything up to its version. Both are in the same format as 'digital-carrot update'
+# files. The manifest is revalidated with its ETag, so a poll where nothing changed is a
+# single 304. Otherwise only the deltas we haven't seen yet are fetched, unless they don't
+# go back far enough, in which case we start over from the snapshot.
+#
+# Returns the latest version and the updates to merge, oldest first. Raises OSError,
+# http.client.HTTPException, ValueError, KeyError or TypeError if the server couldn't be
+# synced with.
+def fetch_updates(client, url, headers, version, timeout=SYNC_TIMEOUT):
+    status, body = client.get(url, headers, timeout)
+    if status != 200:
+        raise ValueError(f"{url} returned {status}")
+    try:
+        manifest = json.loads(body)
+        latest = manifest["version"]
+        deltas = sorted(manifest.get("deltas", []), key=lambda delta: delta["version"])
+        snapshot = manifest.get("snapshot")
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"{url} isn't a sync manifest: {type(e).__name__}: {e}")
+    if latest == version:
+        return latest, []
+
+    files = [delta for delta in deltas if version is not None and delta["version"] > version]
+    if not files or files[0]["version"] != version + 1:
+        if snapshot:
+            files = [snapshot] + [delta for delta in deltas if delta["version"] > snapshot["version"]]
+        else:
+            # Merging is additive, so replaying deltas we already have is harmless.
+            files = deltas
+
+    updates = []
+    for file in files:
+        # These never change, so they don't need to be kept in the HTTP cache.
+        file_url = urllib.parse.urljoin(url, file["url"])
+        status, _, body = client.request(file_url, {**headers, "Connection": "keep-alive"}, timeout)
+        if status != 200:
+            raise ValueError(f"{file_url} returned {status}")
+        updates.append(json.loads(body))
+    return latest, updates
+
+
+# Settings of a synced condition that have to be numbers, and the smallest value each
+# one can take.
+SYNCED_NUMBERS = {
+    "timeout": 1,
+    "cache_ttl": 0,
+    "failure_cache_ttl": 0,
+    "check_interval": 0,
+    "cpu_limit": 1,
+    "memory_limit": 1,
+    "open_files_limit": 1,
+    "output_limit": 0,
+    "max_pause_days": 0,
+    "require_streak": 0,
+}
+SYNCED_STRINGS = ("type", "script", "url", "json_path", "run_as")
+
+
+def is_number(value, minimum=None):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    return minimum is None or value >= minimum
+
+
+def is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+# Checks the settings that a condition and its pause_condition share. Settings that
+# are null are left at their defaults.
+def valid_synced_settings(cfg):
+    for key, minimum in SYNCED_NUMBERS.items():
+        if cfg.get(key) is not None and not is_number(cfg[key], minimum):
+            return False
+    return cfg.get("pause_args") is None or is_string_list(cfg["pause_args"])
+
+
+# Conditions from the sync server haven't been through the client's validation. Returns
+# the condition with its defaults filled in, or None if it can't be used.
+def synced_condition(cfg):
+    if not isinstance(cfg, dict) or not valid_synced_settings(cfg):
+        return None
+    cfg = {key: value for key, value in cfg.items() if value is not None}
+    require_on = cfg.get("require_on")
+    if not is_string_list(require_on) or not set(require_on) <= set(WEEKDAYS.values()):
+        return None
+    if not all(isinstance(cfg.get(key, ""), str) for key in SYNCED_STRINGS):
+        return None
+    kind = cfg.get("type", "script")
+    if kind == "script" and not cfg.get("script"):
+        return None
+    if kind != "script" and kind not in BUILTIN_CONDITIONS:
+        return None
+    if cfg.get("comparison", ">=") not in COMPARISONS:
+        return None
+    if "threshold" in cfg and not is_number(cfg["threshold"]):
+        return None
+    headers = cfg.get("headers", {})
+    if not isinstance(headers, dict) or not all(isinstance(v, str) for v in headers.values()):
+        return None
+    cfg = {"args": [], **cfg}
+    if not is_string_list(cfg["args"]):
+        return None
+    if (pause := cfg.get("pause_condition")) is not None:
+        if not isinstance(pause, dict) or not valid_synced_settings(pause):
+            return None
+        cfg["pause_condition"] = {"pause_args": [], **{k: v for k, v in pause.items() if v is not None}}
+    return cfg
+
+
+# The next time the day rolls over (2am).
+def next_rollover(clock=SYSTEM_CLOCK):
+    rollover = from_now(days=0, clock=clock)
+    if datetime.datetime.fromisoformat(rollover) <= clock.now():
+        rollover = from_now(days=1, clock=clock)
+    return rollover
+
+
+# The day that goals are being tracked for. Days start at 2am.
+def goal_day(clock=SYSTEM_CLOCK):
+    return (clock.now() - datetime.timedelta(hours=2)).date().isoformat()
+
+
+# Convert an ISO formatted wall clock time into a monotonic deadline.
+def monotonic_at(iso, clock=SYSTEM_CLOCK):
+    delta = datetime.datetime.fromisoformat(iso) - clock.now()
+    return clock.monotonic() + delta.total_seconds()
+
+# Every condition run, kept in sqlite. Besides the runs themselves there's one row per
+# condition and day with how many runs passed, so that streaks and success rates only
+# have to look at one row per day, and a streak only as many rows as it is long.
+class History():
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            timestamp REAL NOT NULL,
+            day TEXT NOT NULL,
+            condition TEXT NOT NULL,
+            returncode INTEGER NOT NULL,
+            timed_out INTEGER NOT NULL,
+            duration REAL NOT NULL,
+            digest TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS runs_by_condition ON runs (condition, day);
+        CREATE TABLE IF NOT EXISTS days (
+            condition TEXT NOT NULL,
+            day TEXT NOT NULL,
+            passed INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            paused INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (condition, day)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, clock=SYSTEM_CLOCK):
+        self.path = path
+        self.clock = clock
+        self.db = None
+
+    # Opened on first use, so that it belongs to the process and thread that uses it.
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(self.SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    # Takes a dict of condition name to ScriptResult.
+    def record(self, results, day):
+        now = self.clock.time()
+        db = self.connect()
+        with db:
+            for name, r in results.items():
+                passed = r.returncode == 0 and not r.timed_out
+                # A run that timed out has no exit code. The column predates that, so
+                # those are stored as -1 and told apart by timed_out.
+                returncode = -1 if r.returncode is None else r.returncode
+                db.execute(
+                    "INSERT INTO runs (timestamp, day, condition, returncode, timed_out, duration, digest) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (now, day, name, returncode, r.timed_out, r.duration, hash(f"{r.stdout}\0{r.stderr}")),
+                )
+                db.execute(
+                    "INSERT INTO days (condition, day, passed, failed) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (condition, day) DO UPDATE SET "
+                    "passed = passed + excluded.passed, failed = failed + excluded.failed",
+                    (name, day, int(passed), int(not passed)),
+                )
+
+    # Paused days don't count towards a streak, but they don't break it either.
+    def record_pause(self, name, first_day, last_day):
+        day = datetime.date.fromisoformat(first_day)
+        last = datetime.date.fromisoformat(last_day)
+        db = self.connect()
+        with db:
+            while day <= last:
+                db.execute(
+                    "INSERT INTO days (condition, day, paused) VALUES (?, ?, 1) "
+                    "ON CONFLICT (condition, day) DO UPDATE SET paused = 1",
+                    (name, day.isoformat()),
+                )
+                day += datetime.timedelta(days=1)
+
+    # Consecutive required days on which the condition passed, counting back from today.
+    # Not having passed yet today doesn't break it. Stops counting at limit.
+    def streak(self, name, require_on, today, limit=None):
+        if not require_on:
+            return 0
+        rows = self.connect().execute(
+            "SELECT day, passed, paused FROM days WHERE condition = ? AND day <= ? ORDER BY day DESC",
+            (name, today),
+        )
+        row = next(rows, None)
+        day = datetime.date.fromisoformat(today)
+        streak = 0
+        while limit is None or streak < limit:
+            if WEEKDAYS[day.weekday()] in require_on:
+                while row is not None and row[0] > day.isoformat():
+                    row = next(rows, None)
+                found = row is not None and row[0] == day.isoformat()
+                if found and row[1]:
+                    streak += 1
+                elif not (found and row[2]) and day.isoformat() != today:
+                    break
+            day -= datetime.timedelta(days=1)
+        return streak
+
+    # Returns (current streak, best streak, required days, days passed) since the
+    # condition was first run, or since the given day.
+    def summary(self, name, require_on, today, since=None):
+        rows = self.connect().execute(
+            "SELECT day, passed, paused FROM days WHERE condition = ? AND day >= ? AND day <= ? ORDER BY day",
+            (name, since or "", today),
+        ).fetchall()
+        if not rows or not require_on:
+            return 0, 0, 0, 0
+
+        by_day = {day: (passed, paused) for day, passed, paused in rows}
+        day = datetime.date.fromisoformat(rows[0][0])
+        last = datetime.date.fromisoformat(today)
+        current = best = required = met = 0
+        while day <= last:
+            passed, paused = by_day.get(day.isoformat(), (0, 0))
+            if WEEKDAYS[day.weekday()] in require_on and not paused:
+                if passed:
+                    current += 1
+                    met += 1
+                    required += 1
+                elif day != last:
+                    current = 0
+                    required += 1
+                best = max(best, current)
+            day += datetime.timedelta(days=1)
+        return current, best, required, met
+
+    # Average and slowest run time per week, oldest first.
+    def latency(self, name, since):
+        return self.connect().execute(
+            "SELECT strftime('%Y-W%W', day) AS week, count(*), avg(duration), max(duration) FROM runs "
+            "WHERE condition = ? AND day >= ? GROUP BY week ORDER BY week",
+            (name, since),
+        ).fetchall()
+
+
+# A file that the daemon keeps on disk. The expected content lives in memory and the
+# stat tuple records what the file looked like the last time it was verified, so that
+# an untouched file can be skipped without reading it.
+class Artifact():
+    def __init__(self, path, content, mode):
+        self.path = path
+        self.content = content.encode("utf-8")
+        self.sha = hashlib.sha256(self.content).hexdigest()
+        self.mode = mode
+        self.stat = None
+
+    # The file is written next to its final path and renamed over it, so a crash never
+    # leaves half of it behind.
+    def write(self):
+        metrics.inc("digital_carrot_file_writes_total")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.content)
+        os.chmod(tmp, self.mode)
+        os.replace(tmp, self.path)
+
+    # Make sure the file on disk matches what we have in memory. Returns True if the
+    # file had to be repaired.
+    def verify(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.write()
+            self.stat = stat_key(os.stat(self.path))
+            return True
+
+        if stat_key(st) == self.stat:
+            return False
+
+        repaired = False
+        if st.st_size != len(self.content) or file_hash(self.path) != self.sha:
+            self.write()
+            repaired = True
+        elif stat.S_IMODE(st.st_mode) != self.mode:
+            os.chmod(self.path, self.mode)
+            repaired = True
+
+        self.stat = stat_key(os.stat(self.path))
+        return repaired
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def encode_record(record):
+    data = json.dumps(record, separators=(",", ":")).encode("utf-8")
+    return b"%08x %s\n" % (zlib.crc32(data), data)
+
+
+# Returns None for a record that was cut short or doesn't match its checksum.
+def parse_record(line):
+    if not line.endswith(b"\n"):
+        return None
+    checksum, _, data = line[:-1].partition(b" ")
+    try:
+        if int(checksum, 16) != zlib.crc32(data):
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def apply_record(state, record):
+    *parents, key = record["path"]
+    for part in parents:
+        state = state[part]
+    if record["op"] == "set":
+        state[key] = record["value"]
+    elif record["op"] == "del":
+        state.pop(key, None)
+    elif record["op"] == "extend":
+        state[key][record["at"]:] = record["value"]
+    else:
+        raise ValueError(f"Unknown journal op: {record['op']}")
+
+
+# The daemon's state is a snapshot in config.json plus a journal of the changes made
+# since it was written. Changes are buffered and appended to the journal together, with
+# a single fsync, whenever the state is saved, so writes are proportional to what
+# changed. Once the journal grows past max_bytes it is folded into a new snapshot, which
+# is written to a temporary file and renamed into place.
+#
+# Every record is a line of "<crc32> <json>" that sets, deletes or extends the value at
+# a path in the state. Replaying stops at the first record that doesn't check out, which
+# is where a write was cut short. Replaying a record twice gives the same result, so a
+# crash between writing a snapshot and emptying the journal loses nothing.
+class StateJournal():
+    def __init__(self, snapshot_path, journal_path, max_bytes=JOURNAL_MAX_BYTES):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.size = 0
+        # Stat of the journal after our last write, so we notice anyone else writing to it.
+        self.stat = None
+        # Until load() says otherwise, whatever is on disk isn't ours.
+        self.needs_snapshot = True
+
+    # Read the snapshot and replay the journal on top of it. Returns the state and the
+    # snapshot's contents.
+    def load(self):
+        with open(self.snapshot_path, "r") as f:
+            snapshot = f.read()
+        state = json.loads(snapshot)
+
+        self.needs_snapshot = False
+        replayed = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        if (record := parse_record(line)) is None:
+                            raise ValueError("bad checksum")
+                        apply_record(state, record)
+                    except (ValueError, KeyError, IndexError, TypeError) as e:
+                        # Anything after this point can't be trusted, and new records
+                        # mustn't be appended after it, so start over from a snapshot.
+                        logger.warning(f"Ignoring the rest of {self.journal_path}: {e}")
+                        self.needs_snapshot = True
+                        break
+                    replayed += 1
+                st = os.fstat(f.fileno())
+                self.size = st.st_size
+                self.stat = stat_key(st)
+        except FileNotFoundError:
+            pass
+
+        metrics.inc("digital_carrot_journal_replayed_total", replayed)
+        return state, snapshot
+
+    def set(self, path, value):
+        self.pending.append(encode_record({"op": "set", "path": path, "value": value}))
+
+    def delete(self, path):
+        self.pending.append(encode_record({"op": "del", "path": path}))
+
+    def extend(self, path, at, values):
+        self.pending.append(encode_record({"op": "extend", "path": path, "at": at, "value": values}))
+
+    # Write out the buffered records. Returns the new snapshot if one was written.
+    def flush(self, state):
+        data = b"".join(self.pending)
+        if self.needs_snapshot or self.size + len(data) > self.max_bytes:
+            return self.compact(state)
+        if not data:
+            return None
+
+        with open(self.journal_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            self.stat = stat_key(os.fstat(f.fileno()))
+        self.size += len(data)
+        self.pending = []
+        metrics.inc("digital_carrot_journal_bytes_total", len(data))
+        return None
+
+    def compact(self, state):
+        snapshot = json.dumps(state, indent=4)
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, self.snapshot_path)
+        # The rename has to be on disk before the journal is emptied.
+        fsync_dir(os.path.dirname(self.snapshot_path))
+
+        with open(self.journal_path, "wb") as f:
+            os.fsync(f.fileno())
+            self.stat = stat_key(os.fstat(f.fileno()))
+        self.size = 0
+        self.pending = []
+        self.needs_snapshot = False
+        metrics.inc("digital_carrot_snapshots_total")
+        return snapshot
+
+    # True if the journal was changed by someone other than us.
+    def tampered(self):
+        try:
+            st = stat_key(os.stat(self.journal_path))
+        except FileNotFoundError:
+            st = None
+        return st != self.stat
+
+
+# Condition scripts, stored once by the sha256 of their source. Conditions point at a
+# blob by its hash, so conditions that share a script share one copy in memory and one
+# file on disk, BLOB_DIR/<sha>. A blob is dropped once no condition uses it.
+class ScriptStore():
+    def __init__(self):
+        self.blobs = {}
+        self.refs = {}
+        self.names = {}
+        # Stat of blob files that were read (and so verified) from disk, keyed by sha.
+        self.verified = {}
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def sha(self, name):
+        return self.names[name]
+
+    def source(self, name):
+        return self.blobs[self.names[name]]
+
+    def path(self, sha):
+        return os.path.join(BLOB_DIR, sha)
+
+    def add(self, name, source):
+        sha = hash(source)
+        if self.names.get(name) == sha:
+            return sha
+        self.remove(name)
+        self.blobs.setdefault(sha, source)
+        self.refs[sha] = self.refs.get(sha, 0) + 1
+        self.names[name] = sha
+        return sha
+
+    def remove(self, name):
+        if (sha := self.names.pop(name, None)) is None:
+            return
+        self.refs[sha] -= 1
+        if not self.refs[sha]:
+            del self.refs[sha]
+            del self.blobs[sha]
+            self.verified.pop(sha, None)
+
+    # Read a blob that an earlier instance of the daemon stored. Returns None if it's
+    # missing or doesn't match its hash.
+    def load(self, name, sha):
+        try:
+            with open(self.path(sha), "rb") as f:
+                data = f.read()
+                st = os.fstat(f.fileno())
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != sha:
+            return None
+        if stat.S_IMODE(st.st_mode) == 0o755:
+            self.verified[sha] = stat_key(st)
+        return self.add(name, data.decode("utf-8"))
+
+
+# Watches a single file for changes. On Linux this uses inotify on the parent directory,
+# so that replacing the file is caught as well as editing it. Everywhere else (or if
+# inotify isn't available) every check falls back to comparing (mtime, size, inode).
+# The file is only hashed once one of those cheap checks says something happened.
+class FileWatcher():
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_IGNORED = 0x8000
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        self.name = os.path.basename(self.path).encode("utf-8")
+        self.sha = None
+        self.stat = None
+        self.dirty = True
+        self.fd = None
+        self.start_inotify()
+
+    def start_inotify(self):
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                return
+            directory = os.path.dirname(self.path).encode("utf-8")
+            if libc.inotify_add_watch(fd, directory, self.WATCH_MASK) < 0:
+                os.close(fd)
+                return
+            self.fd = fd
+        except (OSError, AttributeError):
+            logger.info("inotify is unavailable, falling back to polling " + self.path)
+
+    # File descriptor that becomes readable when the file changes, or None if we're
+    # polling.
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # Drain the inotify queue and mark the file dirty if any event was about it.
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+                offset += 16 + length
+                if mask & (self.IN_Q_OVERFLOW | self.IN_IGNORED) or name == self.name:
+                    self.dirty = True
+                if mask & self.IN_IGNORED:
+                    # The watched directory went away. Poll from now on.
+                    self.close()
+                    return
+
+    # Record the current state of the file as the known good one. Pass the sha if it is
+    # already known to save reading the file again.
+    def update(self, sha=None):
+        st = os.stat(self.path)
+        self.stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        self.sha = sha or file_hash(self.path)
+        self.dirty = False
+
+    # Returns True if the contents of the file differ from the last call to update().
+    def changed(self):
+        if self.fd is not None:
+            self.read_events()
+            if not self.dirty:
+                return False
+        self.dirty = False
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if key == self.stat:
+            return False
+
+        self.stat = key
+        metrics.inc("digital_carrot_hosts_hashes_total")
+        with metrics.time("digital_carrot_hosts_hash_seconds"):
+            return file_hash(self.path) != self.sha
+
+
+# A heap of named deadlines on the monotonic clock. Scheduling a name that is
+# already pending replaces it. Periodic deadlines are rescheduled from when they were
+# due rather than from when they actually ran, so the cadence doesn't drift.
+class Timers():
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def schedule(self, name, when, callback, interval=None):
+        self.cancel(name)
+        entry = [when, next(self.counter), name, callback, interval, True]
+        self.entries[name] = entry
+        heapq.heappush(self.heap, entry)
+
+    def cancel(self, name):
+        if entry := self.entries.pop(name, None):
+            entry[5] = False
+
+    def scheduled(self, name):
+        return name in self.entries
+
+    # Seconds until the next deadline, or None if nothing is scheduled.
+    def timeout(self, now):
+        while self.heap and not self.heap[0][5]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - now)
+
+    def run_due(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            when, _, name, callback, interval, active = heapq.heappop(self.heap)
+            if not active:
+                continue
+            del self.entries[name]
+            if interval is not None:
+                # Skip the slots we missed (eg. while the laptop was asleep).
+                when += interval * (int((now - when) // interval) + 1)
+                self.schedule(name, when, callback, interval)
+            callback()
+
+
+# Reversed-label suffix trie of blocked domains. Blocking a domain blocks all of its
+# subdomains too, and a lookup costs one dict access per label.
+class DomainTrie():
+    def __init__(self, domains=()):
+        self.root = {}
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        node = self.root
+        for label in reversed(domain.lower().rstrip(".").split(".")):
+            if None in node:
+                # A parent domain is already blocked.
+                return
+            node = node.setdefault(label, {})
+        node.clear()
+        node[None] = True
+
+    def __contains__(self, domain):
+        node = self.root
+        for label in reversed(domain.lower().rstrip(".").split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+def parse_address(address, default_port=53):
+    host, _, port = address.rpartition(":")
+    if not host:
+        return (address, default_port)
+    return (host, int(port))
+
+
+# Skip over a (possibly compressed) name in a DNS message and return the offset after it.
+def skip_dns_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+
+# Parse the question of a DNS query. Returns (name, qtype, qclass, end of question).
+def parse_dns_question(data):
+    labels = []
+    offset = 12
+    while (length := data[offset]) != 0:
+        if length & 0xC0:
+            raise ValueError("Compressed name in question")
+        labels.append(data[offset + 1:offset + 1 + length].decode("ascii", "replace"))
+        offset += length + 1
+    qtype, qclass = struct.unpack_from("!HH", data, offset + 1)
+    return ".".join(labels).lower(), qtype, qclass, offset + 5
+
+
+# The lowest TTL of the answer and authority records in a response, or None if it
+# doesn't have any.
+def min_dns_ttl(data):
+    _, _, qdcount, ancount, nscount, _ = struct.unpack_from("!HHHHHH", data)
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_dns_name(data, offset) + 4
+    ttl = None
+    for _ in range(ancount + nscount):
+        offset = skip_dns_name(data, offset)
+        _, _, record_ttl, rdlength = struct.unpack_from("!HHIH", data, offset)
+        ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        offset += 10 + rdlength
+    return ttl
+
+
+# A small DNS server for 127.0.0.1. Queries for blocked domains (and their subdomains)
+# are answered with localhost, everything else is forwarded to the upstream server and
+# the responses are cached for their TTL. This runs on the daemon's main loop, it never
+# blocks.
+class DnsSinkhole():
+    BLOCKED_TTL = 60
+    NEGATIVE_TTL = 60
+    MAX_TTL = 3600
+    MAX_CACHE = 10000
+    PENDING_TIMEOUT = 5
+
+    def __init__(self, blocked, listen="127.0.0.1:53", upstream="1.1.1.1:53"):
+        self.trie = DomainTrie(blocked)
+        self.blocking = True
+        self.cache = {}
+        self.pending = {}
+        self.next_id = random.randrange(0x10000)
+        self.stats = {"queries": 0, "blocked": 0, "cached": 0, "forwarded": 0}
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(parse_address(listen))
+        self.sock.setblocking(False)
+
+        self.upstream_address = parse_address(upstream)
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.setblocking(False)
+        self.upstream_connected = False
+        self.connect_upstream()
+
+    # This fails while we're offline, so it's tried again by the next query that has to
+    # be forwarded.
+    def connect_upstream(self):
+        try:
+            self.upstream.connect(self.upstream_address)
+        except OSError as e:
+            logger.warning(f"Couldn't connect to the DNS upstream: {e}")
+            return False
+        self.upstream_connected = True
+        return True
+
+    def load(self, blocked):
+        self.trie = DomainTrie(blocked)
+
+    def register(self, selector):
+        selector.register(self.sock, selectors.EVENT_READ, self.on_query)
+        selector.register(self.upstream, selectors.EVENT_READ, self.on_response)
+
+    def close(self):
+        self.sock.close()
+        self.upstream.close()
+
+    # Serve on a private selector until close() is called from another thread. The
+    # daemon registers the sockets on its own loop instead.
+    def serve_forever(self):
+        selector = selectors.DefaultSelector()
+        self.register(selector)
+        try:
+            while self.sock.fileno() != -1:
+                for key, _ in selector.select(1):
+                    key.data()
+                self.expire()
+        except (OSError, ValueError):
+            if self.sock.fileno() != -1:
+                raise
+        finally:
+            selector.close()
+
+    def on_query(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self.handle_query(data, addr)
+            except (ValueError, IndexError, struct.error):
+                logger.debug("Ignoring malformed DNS query")
+
+    def handle_query(self, data, addr):
+        self.stats["queries"] += 1
+        name, qtype, qclass, end = parse_dns_question(data)
+
+        if self.blocking and name in self.trie:
+            self.stats["blocked"] += 1
+            self.reply(self.blocked_response(data, qtype, end), addr)
+            return
+
+        key = (name, qtype, qclass)
+        if (cached := self.cache.get(key)) and cached[0] > time.monotonic():
+            self.stats["cached"] += 1
+            self.reply(data[:2] + cached[1], addr)
+            return
+
+        if not self.upstream_connected and not self.connect_upstream():
+            return
+        upstream_id = self.allocate_id()
+        self.pending[upstream_id] = (addr, data[:2], key, time.monotonic())
+        try:
+            self.upstream.send(struct.pack("!H", upstream_id) + data[2:])
+        except OSError as e:
+            # Eg. the upstream is down (and an ICMP error came back for an earlier query)
+            # or we're offline. The client will ask again.
+            del self.pending[upstream_id]
+            logger.warning(f"Couldn't forward a DNS query to the upstream: {e}")
+            return
+        self.stats["forwarded"] += 1
+
+    def reply(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except OSError as e:
+            logger.warning(f"Couldn't answer a DNS query from {addr[0]}: {e}")
+
+    def allocate_id(self):
+        while self.next_id in self.pending:
+            self.next_id = (self.next_id + 1) & 0xFFFF
+        upstream_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFF
+        return upstream_id
+
+    def blocked_response(self, query, qtype, end):
+        rd = query[2] & 0x01
+        header = query[:2] + struct.pack("!BBHHHH", 0x80 | (query[2] & 0x78) | rd, 0x80, 1, 0, 0, 0)
+        answer = b""
+        if qtype == 1:
+            answer = struct.pack("!HHHIH", 0xC00C, 1, 1, self.BLOCKED_TTL, 4) + socket.inet_aton("127.0.0.1")
+        elif qtype == 28:
+            answer = struct.pack("!HHHIH", 0xC00C, 28, 1, self.BLOCKED_TTL, 16) + socket.inet_pton(socket.AF_INET6, "::1")
+        if answer:
+            header = header[:6] + struct.pack("!H", 1) + header[8:]
+        return header + query[12:end] + answer
+
+    def on_response(self):
+        while True:
+            try:
+                data = self.upstream.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                logger.error("DNS upstream refused the connection")
+                continue
+            except OSError as e:
+                # Not worth logging if we were closed from another thread.
+                if self.upstream.fileno() != -1:
+                    logger.error(f"Couldn't read from the DNS upstream: {e}")
+                return
+            if len(data) < 12:
+                continue
+            pending = self.pending.pop(struct.unpack_from("!H", data)[0], None)
+            if pending is None:
+                continue
+            addr, client_id, key, _ = pending
+            self.cache_response(key, data)
+            self.reply(client_id + data[2:], addr)
+
+    def cache_response(self, key, data):
+        # Don't cache truncated responses or server failures.
+        if data[2] & 0x02 or data[3] & 0x0F not in (0, 3):
+            return
+        try:
+            ttl = min_dns_ttl(data)
+        except (IndexError, struct.error):
+            return
+        ttl = min(self.MAX_TTL, self.NEGATIVE_TTL if ttl is None else ttl)
+        if ttl <= 0:
+            return
+        if len(self.cache) >= self.MAX_CACHE:
+            self.expire()
+            if len(self.cache) >= self.MAX_CACHE:
+                del self.cache[next(iter(self.cache))]
+        self.cache[key] = (time.monotonic() + ttl, data[2:])
+
+    # Forget queries the upstream never answered and cached responses that expired.
+    def expire(self):
+        now = time.monotonic()
+        self.pending = {
+            upstream_id: pending for upstream_id, pending in self.pending.items()
+            if now - pending[3] < self.PENDING_TIMEOUT
+        }
+        self.cache = {key: value for key, value in self.cache.items() if value[0] > now}
+
+
+# A client connected to the command socket.
+class Connection():
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.events = selectors.EVENT_READ
+
+    # Pop every complete request off the input buffer.
+    def read_frames(self):
+        while len(self.inbuf) >= 4:
+            length = struct.unpack_from("!I", self.inbuf)[0]
+            if len(self.inbuf) < 4 + length:
+                return
+            frame = bytes(self.inbuf[4:4 + length])
+            del self.inbuf[:4 + length]
+            yield json.loads(frame.decode("utf-8"))
+
+    def send_frame(self, msg):
+        data = json.dumps(msg).encode("utf-8")
+        self.outbuf += struct.pack("!I", len(data)) + data
+
+
 class AnnoyingScheduler():
     kill_now = False
-    scripts = {}
 
-    def __init__(self, my_plist=None, initial_config=None):
+    # clock and runner (which runs a condition's script, like run_script) are only ever
+    # swapped out by the simulator.
+    def __init__(self, my_plist=None, initial_config=None, source=None, clock=SYSTEM_CLOCK, runner=run_script):
         self.name = my_plist
+        self.clock = clock
+        self.runner = runner
         logger.info("Starting")
 
         # If an initial config is provided, save it to memory, otherwise use
-        # the file that was saved to disk.
+        # the state that was saved to disk.
+        self.journal = StateJournal(CONFIG_FILE, JOURNAL_FILE)
+        snapshot = None
         if initial_config:
             self.config = initial_config
         else:
-            with open(CONFIG_FILE, "r") as f:
-                self.config = json.loads(f.read())
-
-        self.config["hosts_sha"] = None
-
-        # This is where this script reads itself into memory.
-        with open(__file__, "r") as f:
-            self.self = f.read()
+            self.config, snapshot = self.journal.load()
+
+        self.hosts_sha = None
+
+        # Pid of the supervisor that restarts us, if we're running under one.
+        self.supervisor = None
+        # Set when we're shutting down for good, or when we've started a replacement
+        # that our lock should be handed to.
+        self.exit_allowed = False
+        self.successor = False
+
+        # Index of every file we keep on disk, keyed by path.
+        self.artifacts = {}
+        self.store = ScriptStore()
+        if snapshot is not None:
+            self.artifacts[CONFIG_FILE] = Artifact(CONFIG_FILE, snapshot, 0o644)
+
+        self.hosts_watcher = FileWatcher(HOSTS_FILE)
+
+        self.timers = Timers()
+        self.dns = None
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONDITION_WORKERS)
+        self.warm_pool = None
+        self.http = HttpClient()
+
+        # Cached script results keyed by (script sha, args, day).
+        self.results = {}
+        self.history = History(HISTORY_FILE, clock)
+
+        # Background checks: the ones running right now, how many times in a row each
+        # one has errored, and finished ones waiting to be picked up by the loop.
+        self.checking = set()
+        self.check_errors = {}
+        self.completed_checks = queue.SimpleQueue()
+        self.wakeup_lock = threading.Lock()
+        self.wakeup_writer = None
+
+        # A poll of the sync server that is running, and finished ones.
+        self.syncing = False
+        self.completed_syncs = queue.SimpleQueue()
+
+        self.profiler = Profiler()
+        self.profile_requested = False
+        self.stacks_file = None
+
+        # Set of blocked websites, built the first time we need to add to the list.
+        self.blocked_index = None
+        self.selector = None
+        self.listener = None
+        self.connections = {}
+
+        # This is where this script reads itself into memory, unless a supervisor already
+        # has it.
+        if source is None:
+            with open(__file__, "r") as f:
+                source = f.read()
+        self.self = source
 
         # Add the shebang, so that this can be run on it's own.
         if not self.self.startswith("#!"):
@@ -169,35 +2449,89 @@ class AnnoyingScheduler():
 
     def load_condition_scripts(self, raise_missing=False):
         # Read the condition scripts into memory so that they can't be tampered with.
+        # After a restart they come from the script store, falling back to where the user
+        # keeps them.
         conditions_to_ignore = []
         for name, args in self.config["conditions"].items():
-            if name not in self.scripts:
-                try:
-                    script_path = args.get("internal_script", args["script"])
-                    if not os.path.exists(script_path):
-                        script_path = args["script"]
-                    with open(script_path, "r") as f:
-                        self.scripts[name] = f.read()
-                except FileNotFoundError:
-                    if raise_missing:
-                        raise
-                    conditions_to_ignore.append(name)
+            if args.get("type", "script") != "script" or name in self.store:
+                continue
+            if (sha := args.get("script_sha")) and self.store.load(name, sha):
+                continue
+            try:
+                script_path = args.get("internal_script", args["script"])
+                if not os.path.exists(script_path):
+                    script_path = args["script"]
+                with open(script_path, "r") as f:
+                    self.store.add(name, f.read())
+            except (OSError, UnicodeDecodeError) as e:
+                # A script that can't be read (eg. a directory or a binary) is as good as
+                # missing.
+                if raise_missing:
+                    raise
+                logger.warning(f"Dropping condition '{name}', its script can't be read: {e}")
+                conditions_to_ignore.append(name)
         for name in conditions_to_ignore:
-            del self.config["conditions"][name]
+            self.delete_state(["conditions", name])
+
+    # Every change to the config goes through these, so that it ends up in the journal.
+    # Setting a value to what it already is doesn't write anything.
+    def set_state(self, path, value):
+        *parents, key = path
+        target = self.config
+        for part in parents:
+            target = target[part]
+        if key in target and target[key] == value:
+            return
+        target[key] = value
+        self.journal.set(path, value)
+
+    def delete_state(self, path):
+        *parents, key = path
+        target = self.config
+        for part in parents:
+            target = target[part]
+        if key in target:
+            del target[key]
+            self.journal.delete(path)
+
+    def extend_state(self, path, values):
+        if not values:
+            return
+        target = self.config
+        for part in path:
+            target = target[part]
+        self.journal.extend(path, len(target), values)
+        target.extend(values)
+
+    # Write the changes since the last save to the journal. When that writes a new
+    # snapshot, it becomes the copy of config.json that we keep on disk.
+    def save_state(self):
+        if (snapshot := self.journal.flush(self.config)) is not None:
+            artifact = Artifact(CONFIG_FILE, snapshot, 0o644)
+            artifact.stat = stat_key(os.stat(CONFIG_FILE))
+            self.artifacts[CONFIG_FILE] = artifact
 
     # This method dumps all of the stuff that is held in memory to disk, to prevent
-    # tampering.
+    # tampering. Only files that are missing or differ from what we expect get written.
     def dump_to_disk(self, new_name=None):
-        # Scripts are renamed, made executable and stored in a safe location.
-        for name, script in self.scripts.items():
-            script_path = os.path.join(WORKING_DIR, name)
-            with open(script_path, "w") as f:
-                f.write(script)
-                subprocess.call(f"sudo chmod u+x {script_path}".split(" "))
-                self.config["conditions"][name]["internal_script"] = script_path
-
-        with open(CONFIG_FILE, "w") as f:
-            f.write(json.dumps(self.config, indent=4))
+        with metrics.time("digital_carrot_dump_to_disk_seconds"):
+            self.sync_artifacts(new_name)
+
+    def sync_artifacts(self, new_name=None):
+        expected = {}
+
+        # Scripts are stored by their hash in a safe location, and made executable (by
+        # the user they run as too).
+        for sha, script in self.store.blobs.items():
+            expected[self.store.path(sha)] = (script, 0o755)
+        for name, sha in self.store.names.items():
+            self.set_state(["conditions", name, "script_sha"], sha)
+            # Scripts used to be stored by the name of their condition.
+            if (legacy := self.config["conditions"][name].get("internal_script")) is not None:
+                self.delete_state(["conditions", name, "internal_script"])
+                if os.path.dirname(legacy) == os.path.dirname(CONFIG_FILE):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(legacy)
 
         name = self.name
         if new_name is not None:
@@ -206,41 +2540,70 @@ class AnnoyingScheduler():
         assert name is not None
 
         # Write this script back to disk.
-        with open(self.get_python_file(name), "w") as f:
-            f.write(self.self)
-
-        subprocess.call(f"sudo chmod u+x {self.get_python_file(name)}".split(" "))
+        expected[self.get_python_file(name)] = (self.self, 0o744)
 
-        # Write the MacOS .plist config back to disk.
-        with open(self.get_plist_file(name), "w") as f:
-            new_plist = PLIST.format(
+        # Write the launchd .plist or systemd unit back to disk.
+        if (service_file := self.get_service_file(name)) is not None:
+            template = PLIST if service_backend(self.config) == "launchd" else SYSTEMD_UNIT
+            service = template.format(
                 log_path=os.path.join(WORKING_DIR, "out.log"),
                 file=self.get_python_file(name),
                 name=name,
             )
-            f.write(new_plist)
+            expected[service_file] = (service, 0o644)
+
+        artifacts = {}
+        for path, (content, mode) in expected.items():
+            artifact = self.artifacts.get(path)
+            if artifact is None or artifact.content != content.encode("utf-8") or artifact.mode != mode:
+                artifact = Artifact(path, content, mode)
+                # Blobs that we just read and checked don't need checking again.
+                artifact.stat = self.store.verified.pop(os.path.basename(path), None)
+            artifacts[path] = artifact
+
+        self.store.verified.clear()
+
+        # Blobs that are no longer used by any condition.
+        with contextlib.suppress(FileNotFoundError):
+            for entry in os.listdir(BLOB_DIR):
+                if (path := os.path.join(BLOB_DIR, entry)) not in artifacts:
+                    os.remove(path)
+
+        # The snapshot of the config is only replaced when the journal is compacted.
+        if (snapshot := self.artifacts.get(CONFIG_FILE)) is not None:
+            artifacts[CONFIG_FILE] = snapshot
+        self.artifacts = artifacts
+        self.save_state()
+
+        self.verify_artifacts()
+
+    # Cheap check run on every tick. Files whose stat tuple hasn't changed since we
+    # last looked at them are skipped, everything else gets hashed and repaired.
+    def verify_artifacts(self):
+        if self.journal.tampered():
+            logger.info(JOURNAL_FILE + " was changed. Fixing.")
+            self.journal.needs_snapshot = True
+            self.save_state()
+        for artifact in self.artifacts.values():
+            if artifact.verify():
+                logger.info(artifact.path + " was changed. Fixing.")
 
     # This function clears the blocked websites out of /etc/hosts
     def clear_hosts(self):
-        with open(HOSTS_FILE, "r") as hosts:
-            data = hosts.read()
+        patch_hosts(HOSTS_FILE, None)
 
-        with open(HOSTS_FILE, "w") as hosts:
-            hosts.write(re.sub(r"#fitblock\n[\s\S]*#/fitblock", "", data, flags=re.S))
-
-    # Set the blocked websites in /etc/hosts to point to localhost.
+    # Set the blocked websites in /etc/hosts to point to localhost. This also repairs the
+    # block if it was modified.
     def set_hosts(self):
-        blocked = ["#fitblock\n"]
+        blocked = []
         for site in self.config["blocked_websites"]:
             blocked.append(f"127.0.0.1 {site}")
             blocked.append(f"127.0.0.1 www.{site}")
             blocked.append(f"127.0.0.1 *.{site}")
-        blocked.append("\n#/fitblock")
-
-        with open(HOSTS_FILE, "a") as hosts:
-            hosts.write("\n".join(blocked))
 
-        self.config["hosts_sha"] = file_hash(HOSTS_FILE)
+        sha = patch_hosts(HOSTS_FILE, blocked)
+        self.hosts_watcher.update(sha)
+        self.hosts_sha = sha
 
     def allow_exit(self):
         if self.config.get("enable_killswitch", True):
@@ -251,21 +2614,34 @@ class AnnoyingScheduler():
     # This gets run when the system detects that it has been killed. If we're allowing
     # the program to stop, it will clean itself up. Otherwise, it copies itself to a
     # new location and starts over.
+    # Under a supervisor we just exit and let it start us again, unless the supervisor
+    # itself is gone.
     def exit_gracefully(self, signum, frame):
         self.kill_now = True
 
-        if not self.allow_exit():
+        if self.allow_exit():
+            self.exit_allowed = True
+        elif self.supervisor is not None and os.getppid() == self.supervisor:
+            logger.info("killed " + str(self.name) + ", waiting to be restarted")
+            return
+        else:
             self.propagate()
+            self.successor = True
 
         logger.info("killed " + str(self.name))
 
         self.delete_self()
 
-    # Generate the MacOS .plist file from the template saved here.
-    def get_plist_file(self, name=None):
+    # Where the launchd .plist or systemd unit lives. The supervisor doesn't need one.
+    def get_service_file(self, name=None):
         if name is None:
             name = self.name
-        return f"/Library/LaunchDaemons/com.example.{name}.plist"
+        backend = service_backend(self.config)
+        if backend == "launchd":
+            return os.path.join(PLIST_DIR, f"com.example.{name}.plist")
+        if backend == "systemd":
+            return os.path.join(SYSTEMD_DIR, f"digital-carrot-{name}.service")
+        return None
 
     def get_python_file(self, name=None):
         if name is None:
@@ -278,31 +2654,42 @@ class AnnoyingScheduler():
         logger.info("Copying self to secure location...")
         new_name = str(uuid.uuid4())
         self.dump_to_disk(new_name=new_name)
-        subprocess.call(LOAD_PLIST_CMD.format(name=new_name).split(" "))
 
-    # Send a message on the output pipe for the digital-carrot client to read.
-    def pipe_out(self, msg):
-        try:
-            out_pipe = os.open(OUT_PIPE, os.O_WRONLY | os.O_NONBLOCK)
-            os.write(out_pipe, msg.encode("utf-8"))
-            os.close(out_pipe)
-        except OSError:
-            logger.error("Could not send to client: " + msg)
+        backend = service_backend(self.config)
+        if backend == "launchd":
+            subprocess.call(LOAD_PLIST_CMD.format(plist=self.get_service_file(new_name)).split(" "))
+        elif backend == "systemd":
+            subprocess.call(["systemctl", "daemon-reload"])
+            subprocess.call(["systemctl", "enable", "--now", os.path.basename(self.get_service_file(new_name))])
+        else:
+            with open(os.path.join(WORKING_DIR, "out.log"), "a") as log:
+                subprocess.Popen(
+                    [self.get_python_file(new_name), new_name],
+                    stdin=subprocess.DEVNULL,
+                    stdout=log,
+                    stderr=log,
+                    start_new_session=True,
+                )
 
     # Clean up any files that this process copied so that it won't automatically run.
     def delete_self(self):
-        os.remove(self.get_plist_file())
-        os.remove(self.get_python_file())
+        # Disabling removes the unit's link in multi-user.target.wants, which would
+        # otherwise be left behind by every respawn.
+        if service_backend(self.config) == "systemd" and os.path.exists(service_file := self.get_service_file()):
+            subprocess.call(["systemctl", "disable", os.path.basename(service_file)])
+        for path in (self.get_service_file(), self.get_python_file()):
+            if path is None:
+                continue
+            self.artifacts.pop(path, None)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
 
     # Read in an updated config from the user. This will only append new websites and
     # conditions. It can't be used to remove anything from the config.
     def update_from_cfg(self, cfg_file):
         with open(cfg_file, "r+") as f:
             cfg = json.loads(f.read())
-            for website in cfg["blocked_websites"]:
-                if website not in self.config["blocked_websites"]:
-                    self.config["blocked_websites"].append(website)
-            self.config["conditions"] = {**cfg["conditions"], **self.config["conditions"]}
+            self.merge_config(cfg)
 
             # Write the current config back to the user's file so that they have an up to date
             # version of it.
@@ -311,51 +2698,156 @@ class AnnoyingScheduler():
             f.truncate()
 
         self.load_condition_scripts()
+        self.evict_results()
         self.dump_to_disk()
+        self.apply_blocklist()
 
         return "Updated " + cfg_file
 
-    def pause(self, num_days, condition):
+    # Add the websites and conditions in cfg that we don't have yet. Returns the number of
+    # websites and conditions that were added.
+    def merge_config(self, cfg):
+        websites = self.add_websites(cfg.get("blocked_websites", []))
+        conditions = 0
+        for name, condition in cfg.get("conditions", {}).items():
+            if name not in self.config["conditions"]:
+                self.set_state(["conditions", name], condition)
+                conditions += 1
+        return websites, conditions
+
+    # Returns True if blocking this website would be redundant. The DNS backend blocks
+    # subdomains, so any blocked parent domain covers it. The hosts file only covers
+    # the exact domain and its www. subdomain.
+    def is_covered(self, website):
+        if website in self.blocked_index:
+            return True
+        if self.config.get("enforcement_backend") == "dns":
+            labels = website.split(".")
+            return any(".".join(labels[i:]) in self.blocked_index for i in range(1, len(labels)))
+        return website.startswith("www.") and website[4:] in self.blocked_index
+
+    # Append websites to the block list, skipping ones that are already covered. Returns
+    # the number of websites that were added.
+    def add_websites(self, websites):
+        if self.blocked_index is None:
+            self.blocked_index = set(self.config["blocked_websites"])
+
+        added = []
+        for website in websites:
+            if not self.is_covered(website):
+                self.blocked_index.add(website)
+                added.append(website)
+        self.extend_state(["blocked_websites"], added)
+        return len(added)
+
+    # Import a file with one website per line, as written by 'digital-carrot import'.
+    def import_blocklist(self, path):
+        with open(path, "r") as f:
+            added = self.add_websites(line.strip() for line in f if line.strip())
+
+        if added:
+            self.dump_to_disk()
+            self.apply_blocklist()
+
+        return f"Blocked {added} new websites from {path}"
+
+    # Push the current list of blocked websites to whichever backend enforces it.
+    def apply_blocklist(self):
+        if self.dns is not None:
+            self.dns.load(self.config["blocked_websites"])
+        elif not self.is_paused():
+            self.set_hosts()
+
+    def pause(self, num_days, condition, progress=None):
         condition_cfg = self.config["conditions"].get(condition)
 
         if not condition_cfg:
-            self.pipe_out(f"Condition {condition} does not exist.")
-            return
+            return f"Condition {condition} does not exist."
 
         if pause_con := condition_cfg.get("pause_condition"):
             max_days = pause_con.get("max_pause_days", 3)
             if num_days > max_days:
-                self.pipe_out(f"You're not allowed to pause more than {max_days} days")
-                return
-            msg, unblocked = self.unblock()
+                return f"You're not allowed to pause more than {max_days} days"
+            if needed := pause_con.get("require_streak"):
+                streak = self.history.streak(condition, condition_cfg["require_on"], goal_day(self.clock), limit=needed)
+                if streak < needed:
+                    return f"You need a {needed} day streak to pause {condition}, you're on {streak}."
+            msg, unblocked = self.unblock(progress=progress)
             if not unblocked:
-                self.pipe_out("Please finish your goals before requesting a longer pause.\n" + msg)
-                return
-            r = subprocess.run([condition_cfg["internal_script"], ] + pause_con["pause_args"], capture_output=True)
+                return "Please finish your goals before requesting a longer pause.\n" + msg
+            r = self.run_conditions({condition: pause_con["pause_args"]})[condition]
 
             if r.returncode == 0:
-                condition_cfg["pause_until"] = from_now(days=num_days)
+                self.set_state(["conditions", condition, "pause_until"], from_now(days=num_days, clock=self.clock))
+                self.record_pause(condition, condition_cfg["pause_until"])
                 self.dump_to_disk()
-                self.pipe_out("Pause successful: " + r.stdout.decode("utf-8"))
+                return "Pause successful: " + r.stdout
+            elif r.timed_out:
+                return "Pause failed: the script timed out."
             else:
-                self.pipe_out("Pause failed: " + r.stdout.decode("utf-8"))
+                return "Pause failed: " + r.stdout
 
         else:
-            self.pipe_out(f"Pausing {condition} is not enabled.")
+            return f"Pausing {condition} is not enabled."
+
+    # Mark every goal day until the pause ends as paused.
+    def record_pause(self, condition, until):
+        last_day = datetime.datetime.fromisoformat(until) - datetime.timedelta(hours=2, seconds=1)
+        try:
+            self.history.record_pause(condition, goal_day(self.clock), last_day.date().isoformat())
+        except sqlite3.Error:
+            logger.exception("Couldn't record the pause")
+
+    # Answer the 'streak', 'rate' and 'latency' commands, for one condition or all of them.
+    def history_report(self, cmd, condition=None, *args):
+        if condition is None:
+            conditions = self.config["conditions"]
+        elif condition in self.config["conditions"]:
+            conditions = {condition: self.config["conditions"][condition]}
+        else:
+            return f"Condition {condition} does not exist."
+
+        report = {"streak": self.streak_report, "rate": self.rate_report, "latency": self.latency_report}[cmd]
+        return report(conditions, *(int(arg) for arg in args))
+
+    def streak_report(self, conditions):
+        lines = []
+        for name, cfg in conditions.items():
+            current, best, _, _ = self.history.summary(name, cfg["require_on"], goal_day(self.clock))
+            lines.append(f"{name}: {current} day streak (best {best})")
+        return "\n".join(lines)
+
+    def rate_report(self, conditions, days=30):
+        today = goal_day(self.clock)
+        since = (datetime.date.fromisoformat(today) - datetime.timedelta(days=days - 1)).isoformat()
+        lines = []
+        for name, cfg in conditions.items():
+            _, _, required, met = self.history.summary(name, cfg["require_on"], today, since)
+            rate = f"{100 * met / required:.0f}%" if required else "-"
+            lines.append(f"{name}: {rate} ({met} of {required} required days met in the last {days} days)")
+        return "\n".join(lines)
+
+    def latency_report(self, conditions, weeks=12):
+        since = (datetime.date.fromisoformat(goal_day(self.clock)) - datetime.timedelta(weeks=weeks)).isoformat()
+        lines = []
+        for name in conditions:
+            lines.append(f"{name}:")
+            for week, runs, average, slowest in self.history.latency(name, since):
+                lines.append(f"  {week}: {runs} runs, {average:.2f}s on average, {slowest:.2f}s at most")
+        return "\n".join(lines)
 
     def purge_failed(self):
         msgs = []
         removed = []
-        conditions_copy = {**self.config["conditions"]}
         for name, cfg in self.config["conditions"].items():
             if cfg.get("validated", False):
                 msgs.append(f"[✓] {name}")
             else:
                 msgs.append(f"[x] {name}")
                 removed.append(name)
-                del conditions_copy[name]
-                del self.scripts[name]
-        self.config["conditions"] = conditions_copy
+                self.store.remove(name)
+        for name in removed:
+            self.delete_state(["conditions", name])
         msg = "Status:\n"
         msg += '\n'.join(msgs)
 
@@ -363,184 +2855,859 @@ class AnnoyingScheduler():
             msg += "\n\nRemoved the following failed conditions:\n"
             msg += '\n'.join(removed)
 
-        self.pipe_out(msg)
-
-    # This is how the daemon receives commands from the client. We're using two named pipes.
-    # There is an input pipe that this daemon listens to commands on and an output pipe that
-    # it will send responses to. To avoid multiple theads, this will simply check the input
-    # pipe every so often for commands. We don't really care about latency, so this is fine.
-    def check_cmds(self):
-        self.init_pipes(create_in=False)
-        data = os.read(self.in_pipe, 4096).decode("utf-8")
-        if len(data) > 0:
-            logger.info("Received command: '" + data + "'")
-            if data.startswith("unblock"):
-                resp, _ = self.unblock()
-                self.pipe_out(resp)
-            elif data.startswith("disable_challenge"):
-                self.pipe_out("Password")
-            elif data.startswith("disable"):
-                challenge_resp = data.split(":", maxsplit=1)[1]
-                if hash(challenge_resp) == self.config["hashed_password"]:
-                    self.clear_hosts()
-                    self.delete_self()
-                    self.kill_now = True
-                    self.pipe_out("Shutting down")
-                else:
-                    self.pipe_out("Wrong password")
-            elif data.startswith("update"):
-                cfg = data.split(":", maxsplit=1)[1]
-                self.pipe_out(self.update_from_cfg(cfg))
-            elif data.startswith("pause"):
-                cmd = data.split(":")
-                days = int(cmd[1])
-                self.pause(days, cmd[2])
-            elif data.startswith("purge"):
-                self.purge_failed()
-            else:
-                self.pipe_out(str(data))
+        return msg
+
+    def disable(self, challenge_resp):
+        if hash(challenge_resp) == self.config["hashed_password"]:
+            self.clear_hosts()
+            self.delete_self()
+            self.kill_now = True
+            self.exit_allowed = True
+            return "Shutting down"
+        return "Wrong password"
+
+    # Run a single command from the client and return the response. Commands that check
+    # conditions pass each condition's line to progress as soon as it's done, if given.
+    def handle_command(self, cmd, args, progress=None):
+        with metrics.time("digital_carrot_command_seconds", command=cmd):
+            return self.run_command(cmd, args, progress)
+
+    def run_command(self, cmd, args, progress=None):
+        logger.info("Received command: '" + cmd + "'")
+        if cmd == "unblock":
+            resp, _ = self.unblock(fresh=bool(args and args[0]), progress=progress)
+        elif cmd == "disable_challenge":
+            resp = "Password"
+        elif cmd == "disable":
+            resp = self.disable(args[0])
+        elif cmd == "update":
+            resp = self.update_from_cfg(args[0])
+        elif cmd == "import":
+            resp = self.import_blocklist(args[0])
+        elif cmd == "pause":
+            resp = self.pause(int(args[0]), args[1], progress)
+        elif cmd == "purge":
+            resp = self.purge_failed()
+        elif cmd == "stats":
+            resp = metrics.render()
+        elif cmd in ("streak", "rate", "latency"):
+            resp = self.history_report(cmd, *args)
+        elif cmd == "logs":
+            resp = "\n".join(recent_logs.tail(int(args[0]) if args else None))
+        elif cmd == "profile":
+            resp = self.start_profile(float(args[0]) if args else DEFAULT_PROFILE_SECONDS)
+        elif cmd == "stacks":
+            resp = thread_stacks()
+        else:
+            resp = f"Unknown command: {cmd}"
+
+        # Commands may have changed the config, so persist it.
+        if not self.kill_now:
+            self.dump_to_disk()
+            self.schedule_wall_clock_deadlines()
+
+        return resp
+
+    # This is how the daemon receives commands from the client. We listen on a unix socket
+    # and messages in both directions are JSON objects, each prefixed with its length as a
+    # 4 byte big endian integer. Requests look like {"id": 1, "cmd": "pause", "args": [...]}
+    # and get a response of {"id": 1, "result": "..."} (or "error" if the command failed).
+    # Any number of clients can connect at once and each one can send as many requests as
+    # it likes without waiting for the responses, which come back in order. Requests with
+    # "stream": true also get a {"id": 1, "progress": "..."} message for each condition as
+    # soon as it's done, before the response.
+    def open_listener(self):
+        self.close_listener()
+        if os.path.exists(COMMAND_SOCKET):
+            os.remove(COMMAND_SOCKET)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(COMMAND_SOCKET)
+        os.chmod(COMMAND_SOCKET, 0o600)
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+        if self.selector is not None:
+            self.selector.register(self.listener, selectors.EVENT_READ, self.on_accept)
+
+    def close_listener(self):
+        for conn in list(self.connections.values()):
+            self.close_connection(conn)
+        if self.listener is not None:
+            if self.selector is not None:
+                self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+
+    def on_accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            conn = Connection(sock)
+            self.connections[sock.fileno()] = conn
+            self.selector.register(sock, selectors.EVENT_READ, lambda conn=conn: self.on_connection(conn))
+
+    def on_connection(self, conn):
+        self.flush(conn)
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.close_connection(conn)
+            return
+
+        conn.inbuf += data
+        try:
+            requests = list(conn.read_frames())
+        except ValueError:
+            logger.error("Received a malformed command")
+            self.close_connection(conn)
+            return
+
+        for request in requests:
+            if not isinstance(request, dict):
+                request = {"cmd": None}
+            progress = None
+            if request.get("stream"):
+                progress = lambda line, request_id=request.get("id"): self.send_progress(conn, request_id, line)
+            try:
+                result = {"result": self.handle_command(request["cmd"], request.get("args", []), progress)}
+            except Exception as e:
+                logger.exception("Command failed")
+                result = {"error": f"{type(e).__name__}: {e}"}
+            conn.send_frame({"id": request.get("id"), **result})
+            self.flush(conn)
+            if self.kill_now:
+                break
+
+    def send_progress(self, conn, request_id, line):
+        if conn.sock.fileno() in self.connections:
+            conn.send_frame({"id": request_id, "progress": line})
+            self.flush(conn)
+
+    # Send as much of the connection's output buffer as the socket will take, and only
+    # ask to be woken up for writing while there is something left.
+    def flush(self, conn):
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+                del conn.outbuf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.close_connection(conn)
+                return
+
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.outbuf else 0)
+        if events != conn.events and self.selector is not None:
+            self.selector.modify(conn.sock, events, self.selector.get_key(conn.sock).data)
+            conn.events = events
+
+    def close_connection(self, conn):
+        if self.connections.pop(conn.sock.fileno(), None) is None:
+            return
+        if self.selector is not None:
+            self.selector.unregister(conn.sock)
+        if conn.outbuf:
+            # Try to get the last response out (eg. when shutting down).
+            try:
+                conn.sock.setblocking(True)
+                conn.sock.settimeout(1)
+                conn.sock.sendall(conn.outbuf)
+            except OSError:
+                pass
+        conn.sock.close()
 
     def heartbeat(self):
         logger.debug("Heartbeat")
 
-    def enforce(self):
+    def persist(self):
         self.dump_to_disk()
+        sync_logs()
 
+    def enforce(self):
+        with metrics.time("digital_carrot_enforce_seconds"):
+            self.enforce_tick()
+
+    def enforce_tick(self):
+        self.heartbeat()
+        if not os.path.exists(COMMAND_SOCKET):
+            self.open_listener()
+        self.verify_artifacts()
+        self.enforce_hosts()
+
+    def is_paused(self):
         if pause := self.config.get("pause_until"):
-            dt = datetime.datetime.fromisoformat(pause)
-            if datetime.datetime.now() < dt:
-                logger.debug("Pause detected.")
-                return
+            return self.clock.now() < datetime.datetime.fromisoformat(pause)
+        return False
+
+    def enforce_hosts(self):
+        if self.dns is not None:
+            self.dns.blocking = not self.is_paused()
+            self.dns.expire()
+            return
 
-        if file_hash(HOSTS_FILE) != self.config["hosts_sha"]:
+        if self.is_paused():
+            logger.debug("Pause detected.")
+            return
+
+        if self.hosts_watcher.changed():
             logger.info(HOSTS_FILE + " was changed. Fixing.")
-            self.clear_hosts()
+            metrics.inc("digital_carrot_hosts_repairs_total")
             self.set_hosts()
         else:
             logger.debug("No changes detected in hosts file.")
 
 
-    def unblock(self):
-        logger.info("Attempting unblock websites.")
-        self.dump_to_disk()
-        messages = []
-        complete = True
+    # Run the scripts for the given conditions in parallel. Takes a dict of condition name
+    # to the arguments to call its script with and returns a dict of condition name to
+    # ScriptResult. Results are served from the cache where possible. on_result, if given,
+    # is called with each condition's name and result as soon as it has one.
+    def run_conditions(self, conditions, fresh=False, on_result=None):
+        now = self.clock.monotonic()
+        day = goal_day(self.clock)
+        results = {}
+        futures = {}
+        for name, args in conditions.items():
+            key = self.result_key(name, args, day)
+            if not fresh and (cached := self.results.get(key)) and cached[0] > now:
+                metrics.inc("digital_carrot_condition_cache_hits_total", condition=name)
+                results[name] = cached[1]
+                if on_result is not None:
+                    on_result(name, cached[1])
+                continue
+
+            futures[self.executor.submit(self.evaluate, name, args)] = (name, key)
+
+        for future in as_completed(futures):
+            name, key = futures[future]
+            results[name] = r = future.result()
+            self.store_result(name, key, r)
+            if on_result is not None:
+                on_result(name, r)
+
+        # Only actual runs go into the history, not cached results.
+        if futures:
+            try:
+                self.history.record({name: results[name] for name, _ in futures.values()}, day)
+            except sqlite3.Error:
+                logger.exception("Couldn't record the results")
+
+        return {name: results[name] for name in conditions}
+
+    def result_key(self, name, args, day=None):
+        return (self.condition_sha(name), tuple(args), day or goal_day(self.clock))
+
+    # Count a finished run and cache its result for at least min_ttl seconds.
+    def store_result(self, name, key, r, min_ttl=0):
+        exit_code = "timeout" if r.timed_out else r.returncode
+        metrics.inc("digital_carrot_condition_runs_total", condition=name, exit_code=exit_code)
+        metrics.observe("digital_carrot_condition_seconds", r.duration, condition=name)
+        if r.max_rss:
+            metrics.observe("digital_carrot_condition_cpu_seconds", r.cpu, condition=name)
+            metrics.set("digital_carrot_condition_max_rss_bytes", r.max_rss, condition=name)
+            logger.debug(f"condition '{name}' used {r.cpu:.3f}s of CPU and {r.max_rss // 1024}KB of memory")
+        if r.truncated:
+            logger.warning(f"condition '{name}' printed too much, the rest of its output was dropped")
+        if ttl := max(self.result_ttl(self.config["conditions"][name], r), min_ttl):
+            self.results[key] = (self.clock.monotonic() + ttl, r)
+
+    # What a condition's result depends on: its script, or its settings if it's built in.
+    def condition_sha(self, name):
+        if name in self.store:
+            return self.store.sha(name)
+        cfg = self.config["conditions"][name]
+        return hash(json.dumps({k: v for k, v in cfg.items() if k in BUILTIN_SETTINGS}, sort_keys=True))
+
+    # Run a single condition. Built in conditions run in the daemon, python scripts go to
+    # the warm pool if it's running, and everything else is executed.
+    def evaluate(self, name, args):
+        script = self.config["conditions"][name]
+        timeout = script.get("timeout", DEFAULT_CONDITION_TIMEOUT)
+        if (kind := script.get("type", "script")) != "script":
+            start = time.monotonic()
+            if kind not in BUILTIN_CONDITIONS:
+                return ScriptResult(1, stderr=f"Unknown condition type {kind}")
+            r = BUILTIN_CONDITIONS[kind](self.http, script, args, timeout)
+            r.duration = time.monotonic() - start
+            return r
+
+        try:
+            sandbox = self.sandbox(script)
+        except KeyError:
+            user = script.get("run_as", self.config.get("run_as"))
+            return ScriptResult(1, stderr=f"Can't run {name} as {user}, there is no such user.")
+
+        # Without one, the shell that sets the limits would run it as a shell script.
+        source = self.store.source(name)
+        if not source.startswith("#!"):
+            return ScriptResult(1, stderr="Error executing script. Did you add a shebang?")
+
+        cmd = [self.store.path(self.store.sha(name)), ] + args
+        if self.warm_pool is not None and is_python_script(source):
+            try:
+                return self.warm_pool.run(cmd, source, timeout, sandbox)
+            except (OSError, ValueError):
+                logger.exception("The warm python pool failed, running the script directly")
+        return self.runner(cmd, timeout, sandbox)
+
+    # The user a condition's script runs as and its limits. Raises KeyError if the user
+    # doesn't exist.
+    def sandbox(self, cfg):
+        memory = cfg.get("memory_limit")
+        sandbox = Sandbox(
+            cpu=cfg.get("cpu_limit", cfg.get("timeout", DEFAULT_CONDITION_TIMEOUT)),
+            memory=memory and memory * 1024 * 1024,
+            open_files=cfg.get("open_files_limit", DEFAULT_OPEN_FILES_LIMIT),
+            output=cfg.get("output_limit", MAX_SCRIPT_OUTPUT),
+        )
+        sandbox.run_as(cfg.get("run_as", self.config.get("run_as")))
+        return sandbox
+
+    # How many seconds a result may be reused for.
+    def result_ttl(self, script, r):
+        if r.timed_out:
+            return 0
+        if r.returncode == 0:
+            ttl = monotonic_at(next_rollover(self.clock), self.clock) - self.clock.monotonic()
+            if (cache_ttl := script.get("cache_ttl")) is not None:
+                ttl = min(ttl, cache_ttl)
+            return ttl
+        return script.get("failure_cache_ttl", DEFAULT_FAILURE_CACHE_TTL)
+
+    # Drop cached results that have expired, that belong to a previous day or whose
+    # script has been changed.
+    def evict_results(self):
+        now = self.clock.monotonic()
+        day = goal_day(self.clock)
+        shas = {self.condition_sha(name) for name in self.config["conditions"]}
+        self.results = {
+            key: value for key, value in self.results.items()
+            if value[0] > now and key[2] == day and key[0] in shas
+        }
+
+    # Split the conditions into the ones that don't have to be met right now, with the
+    # message to show for them, and the ones that do.
+    def pending_conditions(self):
+        messages = {}
+        to_run = {}
 
         for name, script in self.config["conditions"].items():
-            if WEEKDAYS[datetime.datetime.today().weekday()] not in script["require_on"]:
-                messages.append(f"[✓] {name}: Not required today.")
+            if WEEKDAYS[self.clock.now().weekday()] not in script["require_on"]:
+                messages[name] = f"[✓] {name}: Not required today."
                 continue
 
             if pause := script.get("pause_until"):
                 dt = datetime.datetime.fromisoformat(pause)
-                if datetime.datetime.now() < dt:
-                    messages.append(f"[✓] {name}: Paused until {pause}.")
+                if self.clock.now() < dt:
+                    messages[name] = f"[✓] {name}: Paused until {pause}."
                     continue
 
-            cmd = [script["internal_script"], ] + script["args"]
-            try:
-                r = subprocess.run(cmd, capture_output=True)
-                returncode = r.returncode
-                stdout = r.stdout.decode('utf-8').strip()
-                stderr = r.stderr.decode('utf-8').strip()
-            except OSError:
-                returncode = 1
-                stdout = ""
-                stderr = "Error executing script. Did you add a shebang?"
-
-            msg = stdout
-
-            if returncode == 0:
-                check = "✓"
-                self.config["conditions"][name]["validated"] = True
-            elif returncode == 1:
-                self.config["conditions"][name]["validated"] = False
-                check = "x"
-                msg = "This script failed with an unknown error. To purge it from the system 'run digital-carrot purge'"
-                logger.error(f"command '{' '.join(cmd)}' failed")
-                logger.error(stderr)
-                logger.error(stdout)
-                complete = False
-            else:
-                complete = False
-                check = "x"
+            to_run[name] = script
 
-            messages.append(f"[{check}] {name}: {msg}")
+        return messages, to_run
 
+    # Conditions that are checked in the background answer straight from their latest
+    # result, unless a fresh run is asked for.
+    # If progress is given, it is called with each condition's line as soon as that
+    # condition is done, and only the summary is returned.
+    def unblock(self, fresh=False, progress=None):
+        logger.info("Attempting unblock websites.")
+        self.dump_to_disk()
+        messages, to_run = self.pending_conditions()
+        met = {}
+        if progress is not None:
+            for message in messages.values():
+                progress(message)
+
+        def report(name, r):
+            messages[name], met[name] = self.condition_message(name, r)
+            if progress is not None:
+                progress(messages[name])
+
+        self.run_conditions({n: s["args"] for n, s in to_run.items()}, fresh, on_result=report)
+        complete = all(met.values())
+
+        # Keep the messages in the same order as the conditions in the config.
+        if progress is None:
+            messages = [messages[name] for name in self.config["conditions"]]
+        else:
+            messages = []
 
         if complete:
             messages.append("You met all your goals! Well done.")
 
-            self.config["pause_until"] = from_now(days=1)
+            self.set_state(["pause_until"], next_rollover(self.clock))
 
             # test = datetime.datetime.today() + datetime.timedelta(seconds=10)
             # self.config["pause_until"] = test.isoformat()
 
             self.clear_hosts()
+            if self.dns is not None:
+                self.dns.blocking = False
             logger.info("Websites unlocked")
         else:
             messages.append("Still missing some goals.")
 
         return ("\n".join(messages), complete)
 
-    def init_pipes(self, create_in=True):
-        if not os.path.exists(IN_PIPE):
-            os.mkfifo(IN_PIPE, mode=0o644)
-            create_in = True
+    # The line to show for a condition's result, and whether it was met.
+    def condition_message(self, name, r):
+        if r.timed_out:
+            timeout = self.config["conditions"][name].get("timeout", DEFAULT_CONDITION_TIMEOUT)
+            logger.error(f"condition '{name}' timed out")
+            return f"[x] {name}: Timed out after {timeout} seconds.", False
+        if r.returncode == 0:
+            self.set_state(["conditions", name, "validated"], True)
+            return f"[✓] {name}: {r.stdout}", True
+        if r.returncode == 1:
+            self.set_state(["conditions", name, "validated"], False)
+            logger.error(f"condition '{name}' failed")
+            logger.error(r.stderr)
+            logger.error(r.stdout)
+            msg = "This script failed with an unknown error. To purge it from the system 'run digital-carrot purge'"
+            return f"[x] {name}: {msg}", False
+        return f"[x] {name}: {r.stdout}", False
+
+    # Schedule a background check for every condition that has a check_interval and
+    # isn't already scheduled or running.
+    def schedule_checks(self):
+        for name, cfg in self.config["conditions"].items():
+            if cfg.get("check_interval") and name not in self.checking and not self.timers.scheduled("check:" + name):
+                self.schedule_check(name, cfg["check_interval"])
+
+    def schedule_check(self, name, delay):
+        delay *= 1 + random.uniform(-CHECK_JITTER, CHECK_JITTER)
+        self.timers.schedule("check:" + name, self.clock.monotonic() + delay, lambda: self.start_check(name))
+
+    # Run a condition on the executor if it still has to be met today. The result comes
+    # back to the loop through the wakeup pipe.
+    def start_check(self, name):
+        cfg = self.config["conditions"].get(name)
+        if cfg is None or not cfg.get("check_interval"):
+            return
 
-        if not os.path.exists(OUT_PIPE):
-            os.mkfifo(OUT_PIPE, mode=0o644)
+        key = self.result_key(name, cfg["args"])
+        cached = self.results.get(key)
+        met = cached is not None and cached[0] > self.clock.monotonic() and cached[1].returncode == 0
+        if self.is_paused() or met or name not in self.pending_conditions()[1]:
+            self.schedule_check(name, cfg["check_interval"])
+            return
 
-        if create_in:
-            self.in_pipe = os.open(IN_PIPE, os.O_RDONLY | os.O_NONBLOCK)
+        self.checking.add(name)
+        future = self.executor.submit(self.evaluate, name, cfg["args"])
+        future.add_done_callback(lambda f: self.check_done(name, key, f))
 
-    def run(self):
-        got_lock = False
-        lockfile = None
+    # Runs on the executor's thread.
+    def check_done(self, name, key, future):
+        self.completed_checks.put((name, key, future))
+        self.wake()
 
-        for i in range(6):
-            if not is_file_locked(LOCK_FILE):
-                got_lock = True
+    # Get the loop to pick up whatever the executor finished. Safe to call from any thread.
+    def wake(self):
+        with self.wakeup_lock:
+            if self.wakeup_writer is not None:
+                with contextlib.suppress(BlockingIOError):
+                    os.write(self.wakeup_writer, b"\0")
+
+    def finish_checks(self):
+        while True:
+            try:
+                name, key, future = self.completed_checks.get_nowait()
+            except queue.Empty:
                 break
-            logger.info(f"waiting for lock")
-            time.sleep(5)
+            self.checking.discard(name)
+            if (cfg := self.config["conditions"].get(name)) is None or future.cancelled():
+                continue
 
-        if got_lock:
-            lockfile = open(LOCK_FILE, "a")
-            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
-            logger.info(f"got lock")
-        else:
-            logger.info(f"lock timed out")
-            self.delete_self()
+            try:
+                r = future.result()
+            except Exception as e:
+                r = ScriptResult(1, stderr=f"{type(e).__name__}: {e}")
+
+            if r.timed_out or r.returncode not in (0, 2):
+                self.check_errors[name] = self.check_errors.get(name, 0) + 1
+            else:
+                self.check_errors.pop(name, None)
+            interval = cfg["check_interval"]
+            delay = max(interval, min(interval * 2 ** self.check_errors.get(name, 0), MAX_CHECK_BACKOFF))
+
+            # Keep the result around until the next check has had time to replace it.
+            timeout = cfg.get("timeout", DEFAULT_CONDITION_TIMEOUT)
+            self.store_result(name, key, r, min_ttl=delay * (1 + CHECK_JITTER) + timeout)
+            try:
+                self.history.record({name: r}, key[2])
+            except sqlite3.Error:
+                logger.exception("Couldn't record the results")
+
+            if r.returncode == 0 and not self.is_paused() and self.goals_met():
+                logger.info("All goals were met in the background")
+                self.unblock()
+                self.dump_to_disk()
+                self.schedule_wall_clock_deadlines()
+            self.schedule_check(name, delay)
+
+    # True if every condition that has to be met today has a cached success, so that
+    # unblock() wouldn't have to run anything.
+    def goals_met(self):
+        now = self.clock.monotonic()
+        for name, cfg in self.pending_conditions()[1].items():
+            cached = self.results.get(self.result_key(name, cfg["args"]))
+            if cached is None or cached[0] <= now or cached[1].returncode != 0 or cached[1].timed_out:
+                return False
+        return True
+
+    def on_hosts_event(self):
+        fd = self.hosts_watcher.fileno()
+        self.hosts_watcher.read_events()
+        if self.hosts_watcher.fileno() is None:
+            self.selector.unregister(fd)
+        if self.hosts_watcher.dirty:
+            self.enforce_hosts()
+
+    def on_wakeup(self):
+        try:
+            while os.read(self.wakeup_pipe, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.finish_checks()
+        self.finish_syncs()
+        if self.profile_requested:
+            self.profile_requested = False
+            logger.info(self.start_profile(DEFAULT_PROFILE_SECONDS))
+
+    # SIGUSR1 starts a profile. The handler could run in the middle of anything, so the
+    # profile is started by the loop, which the signal wakes up.
+    def request_profile(self, signum, frame):
+        self.profile_requested = True
+
+    def start_profile(self, seconds):
+        if self.profiler.running():
+            return "The daemon is already being profiled."
+        seconds = min(max(seconds, 0), MAX_PROFILE_SECONDS)
+        self.profiler.start()
+        self.timers.schedule("profile", self.clock.monotonic() + seconds, self.finish_profile)
+        return f"Profiling for {seconds:g} seconds. The results will be written to {PROFILE_DIR}"
+
+    def finish_profile(self):
+        if self.profiler.running():
+            logger.info("Wrote profile to " + ", ".join(self.profiler.stop()))
+
+    # Poll the sync server on the executor, unless we're already waiting for it.
+    def start_sync(self):
+        if self.syncing or not (url := self.config.get("sync_url")):
             return
+        self.syncing = True
+        headers = self.config.get("sync_headers", {})
+        future = self.executor.submit(fetch_updates, self.http, url, headers, self.config.get("sync_version"))
+        future.add_done_callback(self.sync_done)
+
+    # Runs on the executor's thread.
+    def sync_done(self, future):
+        self.completed_syncs.put(future)
+        self.wake()
+
+    # Merge what the sync server sent through the same rules as 'digital-carrot update'.
+    def finish_syncs(self):
+        while True:
+            try:
+                future = self.completed_syncs.get_nowait()
+            except queue.Empty:
+                break
+            self.syncing = False
+            if future.cancelled():
+                continue
 
-        signal.signal(signal.SIGINT, self.exit_gracefully)
-        signal.signal(signal.SIGTERM, self.exit_gracefully)
-        self.init_pipes()
+            try:
+                version, updates = future.result()
+            except (OSError, http.client.HTTPException, ValueError, KeyError, TypeError) as e:
+                metrics.inc("digital_carrot_syncs_total", result="error")
+                logger.warning(f"Couldn't sync with {self.config.get('sync_url')}: {type(e).__name__}: {e}")
+                continue
+
+            if not updates and version == self.config.get("sync_version"):
+                metrics.inc("digital_carrot_syncs_total", result="unchanged")
+                continue
+
+            websites = conditions = 0
+            for update in updates:
+                if not isinstance(update, dict):
+                    continue
+                synced = {}
+                for name, cfg in (update.get("conditions") or {}).items():
+                    if (condition := synced_condition(cfg)) is None:
+                        logger.warning(f"Ignoring synced condition '{name}', it isn't valid")
+                    else:
+                        synced[name] = condition
+                blocked = [website for website in update.get("blocked_websites") or [] if isinstance(website, str)]
+                added_websites, added_conditions = self.merge_config({"blocked_websites": blocked, "conditions": synced})
+                websites += added_websites
+                conditions += added_conditions
+            self.set_state(["sync_version"], version)
+            metrics.inc("digital_carrot_syncs_total", result="updated")
+            logger.info(f"Synced to version {version}: {websites} new websites and {conditions} new conditions")
+
+            if conditions:
+                self.load_condition_scripts()
+                self.evict_results()
+                self.schedule_wall_clock_deadlines()
+            self.dump_to_disk()
+            if websites:
+                self.apply_blocklist()
+
+    def schedule_deadlines(self):
+        now = self.clock.monotonic()
+        self.timers.schedule("enforce", now, self.enforce, interval=ENFORCE_INTERVAL)
+        self.timers.schedule("persist", now + PERSIST_INTERVAL, self.persist, interval=PERSIST_INTERVAL)
+        self.timers.schedule("metrics", now + METRICS_INTERVAL, self.write_metrics, interval=METRICS_INTERVAL)
+        if self.config.get("sync_url"):
+            # Spread the polls of a fleet of machines out over the interval.
+            interval = self.config.get("sync_interval", DEFAULT_SYNC_INTERVAL)
+            self.timers.schedule("sync", now + random.uniform(0, interval), self.start_sync, interval=interval)
+        self.schedule_wall_clock_deadlines()
+
+    # Deadlines that depend on the config. These need to be rescheduled whenever the
+    # config changes.
+    def schedule_wall_clock_deadlines(self):
+        if pause := self.config.get("pause_until"):
+            self.timers.schedule("pause_expiry", monotonic_at(pause, self.clock), self.enforce_hosts)
+        self.timers.schedule("rollover", monotonic_at(next_rollover(self.clock), self.clock), self.rollover)
+        self.schedule_checks()
+
+    # Write the metrics in the Prometheus textfile format. The file is replaced atomically
+    # so that the node exporter never reads half of it.
+    def write_metrics(self):
+        path = self.config.get("metrics_textfile", METRICS_FILE)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(metrics.render())
+            os.replace(tmp, path)
+        except OSError:
+            logger.error("Could not write metrics to " + path)
+
+    def rollover(self):
+        logger.info("Starting a new day.")
+        self.evict_results()
+        self.enforce_hosts()
+        self.timers.schedule("rollover", monotonic_at(next_rollover(self.clock), self.clock), self.rollover)
+
+    # The main loop. This sleeps until either a file descriptor we care about becomes
+    # readable (a client command, a change to the hosts file or a signal) or the next
+    # deadline is due.
+    def loop(self):
+        self.selector = selectors.DefaultSelector()
+
+        self.wakeup_pipe, self.wakeup_writer = os.pipe()
+        os.set_blocking(self.wakeup_pipe, False)
+        os.set_blocking(self.wakeup_writer, False)
+        signal.set_wakeup_fd(self.wakeup_writer)
+        self.selector.register(self.wakeup_pipe, selectors.EVENT_READ, self.on_wakeup)
+
+        self.selector.register(self.listener, selectors.EVENT_READ, self.on_accept)
+        if (fd := self.hosts_watcher.fileno()) is not None:
+            self.selector.register(fd, selectors.EVENT_READ, self.on_hosts_event)
+
+        # Block websites with our own DNS server instead of the hosts file.
+        if self.config.get("enforcement_backend") == "dns":
+            self.dns = DnsSinkhole(
+                self.config["blocked_websites"],
+                listen=self.config.get("dns_listen", "127.0.0.1:53"),
+                upstream=self.config.get("dns_upstream", "1.1.1.1:53"),
+            )
+            self.dns.register(self.selector)
+
+        self.schedule_deadlines()
 
         try:
             while not self.kill_now:
-                self.heartbeat()
+                self.timers.run_due(self.clock.monotonic())
+                if self.kill_now:
+                    break
+                for key, _ in self.selector.select(self.timers.timeout(self.clock.monotonic())):
+                    key.data()
+                    if self.kill_now:
+                        break
+        finally:
+            self.close_listener()
+            if self.dns is not None:
+                self.dns.close()
+                self.dns = None
+            signal.set_wakeup_fd(-1)
+            os.close(self.wakeup_pipe)
+            with self.wakeup_lock:
+                os.close(self.wakeup_writer)
+                self.wakeup_writer = None
+            self.selector.close()
+            self.selector = None
+
+    # Returns the exit code for a supervised worker. A supervisor passes in the lock it
+    # already holds.
+    def run(self, lockfile=None):
+        inherited_lock = lockfile is not None
+        if lockfile is None:
+            lockfile = acquire_lock()
+            if lockfile is None:
+                logger.info(f"lock timed out")
+                self.delete_self()
+                return 0
+            logger.info(f"got lock")
 
-                if int(time.time()) % 5 == 0:
-                    self.enforce()
-                    self.check_cmds()
+        # This has to happen before any other threads are started. The log writer's thread
+        # is the exception, the zygote never logs.
+        if self.config.get("python_worker_pool"):
+            self.warm_pool = WarmPool(self.config.get("preload_modules", ["requests"]))
 
-                time.sleep(1)
+        signal.signal(signal.SIGINT, self.exit_gracefully)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+        signal.signal(signal.SIGUSR1, self.request_profile)
+        # Written by faulthandler itself, so that it works even if the loop is stuck.
+        self.stacks_file = open(STACKS_FILE, "a")
+        faulthandler.register(signal.SIGUSR2, self.stacks_file, all_threads=True)
+        self.open_listener()
+        self.dump_to_disk()
+
+        try:
+            self.loop()
         except:
             self.delete_self()
             self.kill_now = True
             raise
         finally:
-            os.close(self.in_pipe)
+            # Whoever runs next picks up from the journal.
+            self.save_state()
+
+            # Unlocking would also unlock it for whoever shares the open file with us, so
+            # a lock that we were given or are giving away is only closed. The hosts file
+            # is still looked after until the new instance has it.
+            if self.successor:
+                tick = None if self.config.get("enforcement_backend") == "dns" else self.enforce_hosts
+                if hand_off_lock(lockfile, tick):
+                    logger.info("handed lock to new instance")
+            elif not inherited_lock:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+            lockfile.close()
+
+            self.hosts_watcher.close()
+            self.close_listener()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            if self.warm_pool is not None:
+                self.warm_pool.close()
+            self.http.close()
+            self.history.close()
+            self.finish_profile()
+            faulthandler.unregister(signal.SIGUSR2)
+            self.stacks_file.close()
+
+        return 0 if self.exit_allowed else RESPAWN_EXIT_CODE
+
+# Keeps a worker running without launchd or systemd. Workers are forks of this process,
+# so restarting one doesn't read any code from disk, and it inherits the lock that we
+# hold for it, so nobody else can take over while it restarts.
+class Supervisor():
+    PR_SET_PDEATHSIG = 1
+
+    # Workers that fail within MIN_UPTIME seconds of starting are restarted after a delay
+    # that doubles up to MAX_BACKOFF seconds, so a broken config can't spin the CPU.
+    MIN_UPTIME = 1
+    MAX_BACKOFF = 5
+
+    def __init__(self, name):
+        self.name = name
+        self.worker = None
+        with open(__file__, "r") as f:
+            self.source = f.read()
+        if not self.source.startswith("#!"):
+            self.source = f"#!{sys.executable}\n\n{self.source}"
+
+    # Signals are passed on to the worker. It decides whether it's allowed to stop, and
+    # tells us with its exit code.
+    def forward(self, signum, frame):
+        if self.worker is not None:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(self.worker, signum)
+
+    def spawn(self, lockfile):
+        parent = os.getpid()
+        pid = os.fork()
+        if pid:
+            return pid
+
+        code = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # If we are killed the worker gets a SIGTERM, and replaces us.
+            if sys.platform.startswith("linux"):
+                ctypes.CDLL(None, use_errno=True).prctl(self.PR_SET_PDEATHSIG, signal.SIGTERM)
+            setup_logging(LOG_FILE)
+
+            scheduler = AnnoyingScheduler(self.name, source=self.source)
+            scheduler.supervisor = parent
+            code = scheduler.run(lockfile)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            close_logs()
+            os._exit(code)
+
+    def run(self):
+        lockfile = acquire_lock()
+        if lockfile is None:
+            logger.info("lock timed out")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(WORKING_DIR, f"{self.name}.py"))
+            return
+        logger.info("got lock")
+
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(signum, self.forward)
+
+        backoff = 0
+        try:
+            while True:
+                started = time.monotonic()
+                self.worker = self.spawn(lockfile)
+                _, status = os.waitpid(self.worker, 0)
+                self.worker = None
+                code = os.waitstatus_to_exitcode(status)
+                if code == 0:
+                    break
+
+                # Being killed isn't a reason to wait, failing on its own is.
+                if code > 0 and code != RESPAWN_EXIT_CODE and time.monotonic() - started < self.MIN_UPTIME:
+                    backoff = min(max(backoff * 2, 0.1), self.MAX_BACKOFF)
+                else:
+                    backoff = 0
+                logger.info(f"worker exited with {code}, restarting")
+                time.sleep(backoff)
+        finally:
             fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
             lockfile.close()
 
+
 def main():
     if len(sys.argv) < 2:
         return
 
-    AnnoyingScheduler(sys.argv[1]).run()
+    # The supervisor only has a few things to say, which end up in out.log. Its workers
+    # set up their own log.
+    if service_backend(read_config()) == "supervisor":
+        setup_logging()
+        Supervisor(sys.argv[1]).run()
+        return
+
+    setup_logging(LOG_FILE)
+    try:
+        AnnoyingScheduler(sys.argv[1]).run()
+    finally:
+        close_logs()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from digital_carrot.benchmarks.scheduler import percentiles, regressions
+
+# Startup benchmarks for the digital-carrot command. Each sample is a fresh interpreter,
+# since that's what a shell prompt or status bar pays for every call. Besides timing, the
+# commands that talk to the daemon are checked to only import the standard library.
+
+# Modules that the commands which only talk to the daemon must not import.
+HEAVY_MODULES = ["pydantic", "digital_carrot.config", "digital_carrot.annoying_scheduler", "digital_carrot.blocklist"]
+
+# Parses the command line the way main() does, without running the command (which would
+# need root and a running daemon).
+STARTUP = """
+import sys
+from digital_carrot import client
+client.get_parser().parse_args({argv!r})
+print(",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+COMMANDS = {
+    "unblock": ["unblock"],
+    "pause": ["pause", "complete_steps", "4"],
+    "purge": ["purge"],
+    "disable": ["disable"],
+    "stats": ["stats"],
+    "logs": ["logs"],
+    "profile": ["profile", "10"],
+    "stacks": ["stacks"],
+}
+
+
+def run_once(argv):
+    code = STARTUP.format(argv=argv, heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    r = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, [name for name in r.stdout.strip().split(",") if name]
+
+
+# Self time of each module in microseconds, from python -X importtime.
+def import_times(argv):
+    code = STARTUP.format(argv=argv, heavy=HEAVY_MODULES)
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    times = {}
+    for line in r.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = times.get(name.strip(), 0) + int(self_us)
+    return times
+
+
+def bench_command(name, argv, iterations):
+    samples = []
+    imported = set()
+    for _ in range(iterations):
+        elapsed, heavy = run_once(argv)
+        samples.append(elapsed)
+        imported.update(heavy)
+
+    slowest = sorted(import_times(argv).items(), key=lambda item: item[1], reverse=True)[:10]
+    return {
+        "benchmark": "cli_startup",
+        "params": {"command": name},
+        "iterations": iterations,
+        "latency_seconds": percentiles(samples),
+        "heavy_imports": sorted(imported),
+        "slowest_imports_us": dict(slowest),
+    }
+
+
+def run(iterations=20):
+    return [bench_command(name, argv, iterations) for name, argv in COMMANDS.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the digital-carrot command's startup time.")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    parser.add_argument("--baseline", help="Results from a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown of the median before it counts as a regression.")
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    report = {"results": results}
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = regressions(results, json.load(f)["results"], args.tolerance)
+
+    # Pulling one of the heavy modules back into the fast path is always a regression.
+    report["heavy_imports"] = {
+        result["params"]["command"]: result["heavy_imports"] for result in results if result["heavy_imports"]
+    }
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if report.get("regressions") or report["heavy_imports"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
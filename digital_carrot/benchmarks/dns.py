@@ -0,0 +1,146 @@
+import argparse
+import json
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from digital_carrot.annoying_scheduler import DnsSinkhole, parse_dns_question
+
+# Throughput benchmark for the DNS sinkhole. Everything runs on localhost: a fake
+# upstream server answers every query it gets, the sinkhole runs on its own thread and
+# the client keeps a fixed number of queries in flight.
+
+
+def build_query(query_id, name, qtype=1):
+    question = b"".join(bytes([len(label)]) + label.encode("ascii") for label in name.split("."))
+    return struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + question + b"\x00" + struct.pack("!HH", qtype, 1)
+
+
+# Answers every A query with 192.0.2.1, as an upstream resolver would.
+class FakeUpstream():
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = "127.0.0.1:%d" % self.sock.getsockname()[1]
+        self.queries = 0
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            self.queries += 1
+            _, _, _, end = parse_dns_question(data)
+            header = data[:2] + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0)
+            answer = struct.pack("!HHHIH", 0xC00C, 1, 1, 300, 4) + socket.inet_aton("192.0.2.1")
+            self.sock.sendto(header + data[12:end] + answer, addr)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.sock.close()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(queries=20000, blocklist=100000, unique=1000, blocked_ratio=0.3, concurrency=64):
+    blocked = [f"blocked{i}.example" for i in range(blocklist)]
+    upstream = FakeUpstream().start()
+
+    start = time.perf_counter()
+    sinkhole = DnsSinkhole(blocked, listen="127.0.0.1:0", upstream=upstream.address)
+    load_time = time.perf_counter() - start
+    listen = sinkhole.sock.getsockname()
+    server = threading.Thread(target=sinkhole.serve_forever, daemon=True)
+    server.start()
+
+    rng = random.Random(0)
+    names = []
+    for _ in range(queries):
+        if rng.random() < blocked_ratio:
+            names.append(f"www.sub.blocked{rng.randrange(blocklist)}.example")
+        else:
+            names.append(f"site{rng.randrange(unique)}.example.org")
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.connect(listen)
+    client.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(client, selectors.EVENT_READ)
+
+    in_flight = {}
+    latencies = []
+    sent = 0
+    lost = 0
+    start = time.perf_counter()
+    while sent < len(names) or in_flight:
+        while sent < len(names) and len(in_flight) < concurrency:
+            query_id = sent & 0xFFFF
+            client.send(build_query(query_id, names[sent]))
+            in_flight[query_id] = time.perf_counter()
+            sent += 1
+        if not selector.select(1):
+            # Anything still in flight after a second of silence got dropped.
+            lost += len(in_flight)
+            in_flight.clear()
+            continue
+        while True:
+            try:
+                data = client.recv(4096)
+            except BlockingIOError:
+                break
+            if (sent_at := in_flight.pop(struct.unpack_from("!H", data)[0], None)) is not None:
+                latencies.append(time.perf_counter() - sent_at)
+    elapsed = time.perf_counter() - start
+
+    sinkhole.close()
+    upstream.close()
+    server.join()
+
+    return {
+        "queries": queries,
+        "blocklist": blocklist,
+        "concurrency": concurrency,
+        "trie_load_seconds": load_time,
+        "elapsed_seconds": elapsed,
+        "queries_per_second": len(latencies) / elapsed,
+        "lost": lost,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "upstream_queries": upstream.queries,
+        "sinkhole": sinkhole.stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DNS sinkhole against a local fake upstream.")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--blocklist", type=int, default=100000)
+    parser.add_argument("--unique", type=int, default=1000, help="Number of distinct names that aren't blocked.")
+    parser.add_argument("--blocked-ratio", type=float, default=0.3)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    print(json.dumps(run(
+        queries=args.queries,
+        blocklist=args.blocklist,
+        unique=args.unique,
+        blocked_ratio=args.blocked_ratio,
+        concurrency=args.concurrency,
+    ), indent=4))
+
+
+if __name__ == "__main__":
+    main()
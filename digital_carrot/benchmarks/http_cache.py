@@ -0,0 +1,117 @@
+import argparse
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from digital_carrot.annoying_scheduler import HttpClient
+
+# Checks the daemon's HTTP client against a stub server on localhost: responses are
+# reused for as long as their Cache-Control allows, revalidated with their ETag after
+# that, and a 304 doesn't change how long the response may be reused unless it says so.
+# Prints what each check saw as JSON and exits with an error if any of them failed.
+
+
+# Serves fixed files, each one (body, headers, headers_304). A 304 is sent with
+# headers_304, or with the file's own headers if that is None. Every request is kept.
+class StubServer():
+    def __init__(self, files=None):
+        self.files = files or {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                if (file := server.files.get(self.path)) is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body, headers, headers_304 = file
+                etag = headers.get("ETag")
+                if etag is not None and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    for name, value in (headers if headers_304 is None else headers_304).items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def count(self, path):
+        return sum(1 for requested, _ in self.requests if requested == path)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def check(name, ok, **seen):
+    return {"check": name, "ok": ok, **seen}
+
+
+def run():
+    body = json.dumps({"data": [{"steps": 12000}]}).encode("utf-8")
+    server = StubServer({
+        "/fresh": (body, {"ETag": '"a"', "Cache-Control": "max-age=60"}, None),
+        # Has to be revalidated every time, but the server leaves its headers off 304s.
+        "/revalidate": (body, {"ETag": '"b"', "Cache-Control": "max-age=0"}, {}),
+    }).start()
+    client = HttpClient()
+    results = []
+    try:
+        for _ in range(3):
+            status, _ = client.get(server.url + "/fresh")
+        requests = server.count("/fresh")
+        results.append(check("fresh responses are reused", status == 200 and requests == 1, requests=requests))
+
+        statuses = [client.get(server.url + "/revalidate")[0] for _ in range(3)]
+        requests = server.count("/revalidate")
+        results.append(check("max-age=0 is kept after a 304", statuses == [200] * 3 and requests == 3,
+                             requests=requests))
+
+        etags = [headers.get("If-None-Match") for path, headers in server.requests if path == "/revalidate"]
+        results.append(check("revalidated with the ETag from the 200", etags == [None, '"b"', '"b"'], etags=etags))
+    finally:
+        client.close()
+        server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the daemon's HTTP cache against a stub server.")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    results = run()
+    output = json.dumps({"results": results}, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from digital_carrot import annoying_scheduler as scheduler
+
+# Benchmarks for the daemon's hot paths. Every scenario runs a real AnnoyingScheduler,
+# but with WORKING_DIR, HOSTS_FILE and the service file directories pointed at a temporary directory so
+# that nothing on the machine is touched. Results are printed as JSON and can be
+# compared against a previous run with --baseline to catch regressions.
+
+ALL_DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# Paths in the scheduler module that live in WORKING_DIR.
+WORKING_PATHS = {
+    name: os.path.basename(getattr(scheduler, name))
+    for name in (
+        "COMMAND_SOCKET", "CONFIG_FILE", "HANDOFF_SOCKET", "HISTORY_FILE", "JOURNAL_FILE", "BLOB_DIR",
+        "KILLSWITCH", "LOCK_FILE", "LOG_FILE", "METRICS_FILE", "PROFILE_DIR", "STACKS_FILE",
+    )
+}
+
+# Audit events that map onto the syscalls we care about.
+AUDIT_EVENTS = {
+    "open": "open",
+    "os.chmod": "chmod",
+    "os.rename": "rename",
+    "os.remove": "remove",
+    "os.mkdir": "mkdir",
+    "subprocess.Popen": "subprocess",
+}
+
+
+# Point the scheduler at a sandbox directory for the duration of the block.
+@contextlib.contextmanager
+def sandbox():
+    root = tempfile.mkdtemp(prefix="digital_carrot_bench_")
+    saved = {name: getattr(scheduler, name) for name in ["WORKING_DIR", "HOSTS_FILE", "PLIST_DIR", "SYSTEMD_DIR", *WORKING_PATHS]}
+    try:
+        working_dir = os.path.join(root, "working")
+        service_dir = os.path.join(root, "services")
+        os.mkdir(working_dir)
+        os.mkdir(service_dir)
+        scheduler.WORKING_DIR = working_dir
+        scheduler.HOSTS_FILE = os.path.join(root, "hosts")
+        scheduler.PLIST_DIR = service_dir
+        scheduler.SYSTEMD_DIR = service_dir
+        for name, filename in WORKING_PATHS.items():
+            setattr(scheduler, name, os.path.join(working_dir, filename))
+        yield root
+    finally:
+        for name, value in saved.items():
+            setattr(scheduler, name, value)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+# Counts file and process operations made while it is active. Audit hooks can't be
+# removed, so a single instance is installed and switched on and off.
+class OperationCounter():
+    def __init__(self):
+        self.active = False
+        self.counts = {}
+        sys.addaudithook(self.audit)
+        self.real_stat = os.stat
+
+    def audit(self, event, args):
+        if self.active and (name := AUDIT_EVENTS.get(event)):
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def stat(self, *args, **kwargs):
+        if self.active:
+            self.counts["stat"] = self.counts.get("stat", 0) + 1
+        return self.real_stat(*args, **kwargs)
+
+    @contextlib.contextmanager
+    def count(self):
+        self.counts = {}
+        self.active = True
+        os.stat = self.stat
+        try:
+            yield self.counts
+        finally:
+            self.active = False
+            os.stat = self.real_stat
+
+
+counter = OperationCounter()
+
+
+def write_hosts(path, entries):
+    with open(path, "w") as f:
+        f.write("127.0.0.1 localhost\n::1 localhost\n")
+        for i in range(entries):
+            f.write(f"0.0.0.0 host{i}.example.net\n")
+
+
+def blocklist(size, prefix="blocked"):
+    return [f"{prefix}{i}.example.com" for i in range(size)]
+
+
+def write_conditions(root, count, sleep=0, exit_code=0):
+    conditions = {}
+    for i in range(count):
+        path = os.path.join(root, f"condition_{i}.sh")
+        with open(path, "w") as f:
+            f.write(f"#!/bin/sh\nsleep {sleep}\necho condition {i}\nexit {exit_code}\n")
+        os.chmod(path, 0o755)
+        conditions[f"condition_{i}"] = {
+            "script": path,
+            "args": [],
+            "require_on": ALL_DAYS,
+            "failure_cache_ttl": 0,
+        }
+    return conditions
+
+
+def make_scheduler(root, conditions=None, websites=None, **kwargs):
+    config = {
+        "blocked_websites": websites or [],
+        "conditions": conditions or {},
+        "hashed_password": scheduler.hash("benchmark"),
+    }
+    sched = scheduler.AnnoyingScheduler("benchmark", initial_config=config, **kwargs)
+    sched.dump_to_disk()
+    return sched
+
+
+def close_scheduler(sched):
+    sched.hosts_watcher.close()
+    sched.executor.shutdown()
+    sched.history.close()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(pct):
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    return {
+        "p50": pick(50),
+        "p90": pick(90),
+        "p99": pick(99),
+        "max": samples[-1],
+        "mean": sum(samples) / len(samples),
+    }
+
+
+# Time a callable. setup runs before each iteration and isn't measured.
+def measure(name, params, fn, iterations, setup=None):
+    samples = []
+    totals = {}
+    for _ in range(iterations):
+        if setup:
+            setup()
+        with counter.count() as counts:
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        for op, value in counts.items():
+            totals[op] = totals.get(op, 0) + value
+
+    return {
+        "benchmark": name,
+        "params": params,
+        "iterations": iterations,
+        "latency_seconds": percentiles(samples),
+        "operations_per_iteration": {op: value / iterations for op, value in sorted(totals.items())},
+    }
+
+
+def bench_enforce(conditions, iterations):
+    with sandbox() as root:
+        write_hosts(scheduler.HOSTS_FILE, 100)
+        sched = make_scheduler(root, write_conditions(root, conditions), blocklist(100))
+        sched.enforce()
+        params = {"conditions": conditions}
+        results = [measure("enforce", {**params, "tampered": False}, sched.enforce, iterations)]
+
+        def tamper():
+            with open(scheduler.HOSTS_FILE, "a") as f:
+                f.write("127.0.0.2 tampered.example\n")
+            with open(sched.store.path(sched.store.sha("condition_0")), "a") as f:
+                f.write("# tampered\n")
+
+        if conditions:
+            results.append(measure("enforce", {**params, "tampered": True}, sched.enforce, iterations, setup=tamper))
+        close_scheduler(sched)
+        return results
+
+
+def bench_dump_to_disk(conditions, iterations):
+    with sandbox() as root:
+        write_hosts(scheduler.HOSTS_FILE, 10)
+        sched = make_scheduler(root, write_conditions(root, conditions))
+        result = measure("dump_to_disk", {"conditions": conditions}, sched.dump_to_disk, iterations)
+        close_scheduler(sched)
+        return [result]
+
+
+def bench_hosts(hosts_entries, websites, iterations):
+    with sandbox() as root:
+        write_hosts(scheduler.HOSTS_FILE, hosts_entries)
+        sched = make_scheduler(root, websites=blocklist(websites))
+        params = {"hosts_entries": hosts_entries, "blocked_websites": websites}
+        results = [
+            measure("set_hosts", params, sched.set_hosts, iterations, setup=sched.clear_hosts),
+            measure("set_hosts_unchanged", params, sched.set_hosts, iterations),
+            measure("clear_hosts", params, sched.clear_hosts, iterations, setup=sched.set_hosts),
+        ]
+        close_scheduler(sched)
+        return results
+
+
+def bench_update_from_cfg(existing, added, iterations):
+    with sandbox() as root:
+        write_hosts(scheduler.HOSTS_FILE, 10)
+        cfg_file = os.path.join(root, "update.json")
+        state = {}
+
+        def setup():
+            if "sched" in state:
+                close_scheduler(state["sched"])
+            state["sched"] = make_scheduler(root, websites=blocklist(existing))
+            with open(cfg_file, "w") as f:
+                json.dump({"blocked_websites": blocklist(added, prefix="new"), "conditions": {}}, f)
+
+        result = measure(
+            "update_from_cfg",
+            {"existing_websites": existing, "added_websites": added},
+            lambda: state["sched"].update_from_cfg(cfg_file),
+            iterations,
+            setup=setup,
+        )
+        close_scheduler(state["sched"])
+        return [result]
+
+
+def bench_unblock(conditions, sleep, exit_code, iterations):
+    with sandbox() as root:
+        write_hosts(scheduler.HOSTS_FILE, 10)
+        sched = make_scheduler(root, write_conditions(root, conditions, sleep, exit_code), blocklist(10))
+        params = {"conditions": conditions, "sleep": sleep, "exit_code": exit_code}
+
+        def reset():
+            sched.results.clear()
+            sched.config.pop("pause_until", None)
+
+        results = [measure("unblock", {**params, "cached": False}, sched.unblock, iterations, setup=reset)]
+        if exit_code == 0:
+            results.append(measure("unblock", {**params, "cached": True}, sched.unblock, iterations))
+        close_scheduler(sched)
+        return results
+
+
+def run(sizes, condition_counts, sleep=0, exit_code=0, iterations=20):
+    results = []
+    for conditions in condition_counts:
+        results += bench_enforce(conditions, iterations)
+        results += bench_dump_to_disk(conditions, iterations)
+        results += bench_unblock(conditions, sleep, exit_code, iterations)
+    for size in sizes:
+        # The bigger scenarios are slow enough that a few iterations will do.
+        n = max(3, min(iterations, 100000 // size))
+        results += bench_hosts(size, min(size, 10000), n)
+        results += bench_hosts(100, size, n)
+        results += bench_update_from_cfg(size, min(size, 10000), n)
+    return results
+
+
+def result_key(result):
+    return json.dumps([result["benchmark"], result["params"]], sort_keys=True)
+
+
+# Returns a list of benchmarks whose median latency got worse than the baseline by more
+# than the tolerance.
+def regressions(results, baseline, tolerance):
+    previous = {result_key(result): result for result in baseline}
+    slower = []
+    for result in results:
+        if (old := previous.get(result_key(result))) is None:
+            continue
+        old_p50 = old["latency_seconds"]["p50"]
+        new_p50 = result["latency_seconds"]["p50"]
+        if new_p50 > old_p50 * (1 + tolerance):
+            slower.append({
+                "benchmark": result["benchmark"],
+                "params": result["params"],
+                "baseline_p50": old_p50,
+                "p50": new_p50,
+            })
+    return slower
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the digital carrot daemon's hot paths.")
+    parser.add_argument("--sizes", type=int_list, default=[10, 1000, 100000],
+                        help="Comma separated hosts file and block list sizes.")
+    parser.add_argument("--conditions", type=int_list, default=[1, 10, 50],
+                        help="Comma separated numbers of condition scripts.")
+    parser.add_argument("--sleep", type=float, default=0, help="How long each condition script sleeps.")
+    parser.add_argument("--exit-code", type=int, default=0, help="Exit code of each condition script.")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    parser.add_argument("--baseline", help="Results from a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown of the median before it counts as a regression.")
+    args = parser.parse_args()
+
+    # Keep the daemon's logging out of the results.
+    scheduler.logger.setLevel(logging.WARNING)
+
+    results = run(args.sizes, args.conditions, args.sleep, args.exit_code, args.iterations)
+    report = {"results": results}
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = regressions(results, json.load(f)["results"], args.tolerance)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import argparse
+import contextlib
+import datetime
+import heapq
+import json
+import logging
+import os
+import random
+import selectors
+import sys
+import time
+from concurrent.futures import Future
+
+from digital_carrot import annoying_scheduler as scheduler
+from digital_carrot.benchmarks.scheduler import (
+    ALL_DAYS, blocklist, close_scheduler, counter, make_scheduler, sandbox, write_conditions, write_hosts,
+)
+
+# Fast-forward simulation of the daemon. A real AnnoyingScheduler runs in the benchmark
+# sandbox, but on a virtual clock that jumps straight to the next deadline in its timer
+# heap, and with condition scripts whose outcome for each day is scripted. Weeks of
+# enforce ticks, rollovers, pauses and background checks play out in seconds, along with
+# a user who tries to unblock every now and then and sometimes tampers with the hosts
+# file or the stored scripts.
+#
+# For every simulated day it reports how long the websites weren't blocked while the
+# goals hadn't been met (enforcement gaps), how long they stayed blocked after they had,
+# and how many file and process operations the daemon made.
+
+DAY = 24 * 60 * 60
+
+
+class VirtualClock():
+    def __init__(self, start):
+        self.current = start
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        return self.current.timestamp()
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance(self, seconds):
+        self.current += datetime.timedelta(seconds=seconds)
+        self.elapsed += seconds
+
+
+# Runs what is submitted to it straight away, so that a check finishes at the simulated
+# time it was started and its result is waiting for the loop.
+class InlineExecutor():
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+# Stands in for run_script. A condition passes once the simulated time is past the time
+# it was scripted to be met at on that goal day.
+class ScriptedRunner():
+    def __init__(self, clock, outcomes):
+        self.clock = clock
+        self.outcomes = outcomes
+        self.paths = {}
+        self.runs = 0
+
+    def __call__(self, cmd, timeout, sandbox):
+        self.runs += 1
+        name = self.paths[cmd[0]]
+        met_at = self.outcomes.get((name, scheduler.goal_day(self.clock)))
+        if met_at is not None and self.clock.now() >= met_at:
+            return scheduler.ScriptResult(0, stdout="Done for today.", duration=0.1)
+        return scheduler.ScriptResult(2, stdout="Not yet.", duration=0.1)
+
+
+@contextlib.contextmanager
+def uncounted():
+    counter.active = False
+    try:
+        yield
+    finally:
+        counter.active = True
+
+
+def required(cfg, day):
+    return scheduler.WEEKDAYS[datetime.date.fromisoformat(day).weekday()] in cfg["require_on"]
+
+
+# The conditions, when each one is met on each goal day (None if it isn't) and what
+# the user does: (seconds since the start, what, argument).
+def make_scenario(rng, start, days, conditions, success_rate, attempts, tampers):
+    outcomes = {}
+    events = []
+    for offset in range(days + 1):
+        day_start = (start + datetime.timedelta(days=offset)).replace(hour=2, minute=0, second=0, microsecond=0)
+        day = day_start.date().isoformat()
+        for i in range(conditions):
+            if rng.random() < success_rate:
+                outcomes[f"condition_{i}", day] = day_start + datetime.timedelta(hours=rng.uniform(6, 20))
+        # The user is awake between 8am and 2am.
+        for _ in range(attempts):
+            events.append((day_start + datetime.timedelta(hours=rng.uniform(6, 24)), "unblock", None))
+        for _ in range(tampers):
+            kind = rng.choice(["hosts", "script"])
+            events.append((day_start + datetime.timedelta(hours=rng.uniform(6, 24)), "tamper", kind))
+
+    # Whether the websites should be blocked only changes when a condition is met or the
+    # day rolls over, so those are observed too.
+    events += [(met_at, "observe", None) for met_at in outcomes.values()]
+    events += [
+        ((start + datetime.timedelta(days=offset)).replace(hour=2, minute=0, second=0, microsecond=0), "observe", None)
+        for offset in range(days + 1)
+    ]
+    seconds = [((when - start).total_seconds(), i, kind, arg) for i, (when, kind, arg) in enumerate(events)]
+    return outcomes, [event for event in seconds if event[0] >= 0]
+
+
+# Whether the hosts file blocks the website. Only read again when the file changed.
+class HostsProbe():
+    def __init__(self, website):
+        self.line = f"127.0.0.1 {website}\n"
+        self.stat = None
+        self.blocked = False
+
+    def __call__(self):
+        st = os.stat(scheduler.HOSTS_FILE)
+        if (key := scheduler.stat_key(st)) != self.stat:
+            self.stat = key
+            with open(scheduler.HOSTS_FILE) as f:
+                self.blocked = self.line in f.read()
+        return self.blocked
+
+
+# True if every condition that has to be met on the clock's goal day has been.
+def goals_met(clock, conditions, outcomes):
+    day = scheduler.goal_day(clock)
+    for name, cfg in conditions.items():
+        if not required(cfg, day):
+            continue
+        met_at = outcomes.get((name, day))
+        if met_at is None or met_at > clock.now():
+            return False
+    return True
+
+
+def tamper(sched, kind, rng):
+    if kind == "hosts":
+        scheduler.patch_hosts(scheduler.HOSTS_FILE, None)
+    elif sched.store.blobs:
+        sha = rng.choice(sorted(sched.store.blobs))
+        with open(sched.store.path(sha), "a") as f:
+            f.write("exit 0\n")
+
+
+def simulate(days=28, conditions=3, websites=1000, success_rate=0.8, check_interval=0, attempts=4, tampers=2,
+             poll=False, start=None, seed=0):
+    rng = random.Random(seed)
+    # Background checks are jittered with the random module.
+    random.seed(seed)
+    start = start or datetime.datetime(2024, 1, 1, 9, 0)
+    outcomes, events = make_scenario(rng, start, days, conditions, success_rate, attempts, tampers)
+    heapq.heapify(events)
+    end = days * DAY
+
+    with sandbox() as root:
+        write_hosts(scheduler.HOSTS_FILE, 100)
+        config = write_conditions(root, conditions)
+        for i, cfg in enumerate(config.values()):
+            if i % 2:
+                cfg["require_on"] = ALL_DAYS[:5]
+            if check_interval:
+                cfg["check_interval"] = check_interval
+
+        clock = VirtualClock(start)
+        runner = ScriptedRunner(clock, outcomes)
+        sched = make_scheduler(root, config, blocklist(websites), clock=clock, runner=runner)
+        runner.paths = {sched.store.path(sha): name for name, sha in sched.store.names.items()}
+        sched.executor.shutdown()
+        sched.executor = InlineExecutor()
+
+        # The parts of loop() that don't need a running daemon. File descriptors are
+        # polled after every step, which is as if the loop woke up for them instantly.
+        sched.selector = selectors.DefaultSelector()
+        if poll:
+            sched.hosts_watcher.close()
+        if (fd := sched.hosts_watcher.fileno()) is not None:
+            sched.selector.register(fd, selectors.EVENT_READ, sched.on_hosts_event)
+        sched.open_listener()
+        sched.schedule_deadlines()
+
+        blocked = HostsProbe(sched.config["blocked_websites"][0])
+        reports = []
+        report = None
+        started = time.perf_counter()
+        with counter.count() as counts:
+            while True:
+                for key, _ in sched.selector.select(0):
+                    key.data()
+                sched.finish_checks()
+
+                now = clock.monotonic()
+                if report is None or report["day"] != scheduler.goal_day(clock) or now >= end:
+                    if report is not None:
+                        report["script_runs"] = runner.runs - runs
+                        report["operations"] = dict(sorted(counts.items()))
+                        reports.append(report)
+                    if now >= end:
+                        break
+                    counts.clear()
+                    runs = runner.runs
+                    report = {
+                        "day": scheduler.goal_day(clock),
+                        "gap_seconds": 0,
+                        "blocked_after_goals_seconds": 0,
+                        "unblock_attempts": 0,
+                        "unblocked": False,
+                        "tampers": 0,
+                    }
+
+                # Nothing changes until the next deadline or event.
+                step = min(x for x in [sched.timers.timeout(now), events[0][0] - now if events else None, end - now]
+                           if x is not None)
+                with uncounted():
+                    is_blocked = blocked()
+                met = goals_met(clock, sched.config["conditions"], outcomes)
+                if not is_blocked and not met:
+                    report["gap_seconds"] += step
+                elif is_blocked and met:
+                    report["blocked_after_goals_seconds"] += step
+
+                clock.advance(step)
+                sched.timers.run_due(clock.monotonic())
+                while events and events[0][0] <= clock.monotonic():
+                    _, _, kind, arg = heapq.heappop(events)
+                    if kind == "unblock":
+                        report["unblock_attempts"] += 1
+                        report["unblocked"] |= sched.unblock()[1]
+                    elif kind == "tamper":
+                        report["tampers"] += 1
+                        with uncounted():
+                            tamper(sched, arg, rng)
+        elapsed = time.perf_counter() - started
+
+        sched.close_listener()
+        sched.selector.close()
+        sched.selector = None
+        close_scheduler(sched)
+
+    return {
+        "params": {
+            "days": days,
+            "conditions": conditions,
+            "websites": websites,
+            "success_rate": success_rate,
+            "check_interval": check_interval,
+            "unblock_attempts": attempts,
+            "tampers": tampers,
+            "poll": poll,
+            "seed": seed,
+        },
+        "wall_seconds": elapsed,
+        "gap_seconds": sum(report["gap_seconds"] for report in reports),
+        "days": reports,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate weeks of the digital carrot daemon in seconds.")
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument("--conditions", type=int, default=3)
+    parser.add_argument("--websites", type=int, default=1000)
+    parser.add_argument("--success-rate", type=float, default=0.8,
+                        help="How likely each condition is to be met on a given day.")
+    parser.add_argument("--check-interval", type=int, default=0,
+                        help="Check the conditions in the background this often, in seconds.")
+    parser.add_argument("--unblock-attempts", type=int, default=4, help="How often a day the user tries to unblock.")
+    parser.add_argument("--tampers", type=int, default=2,
+                        help="How often a day the user edits the hosts file or a stored script.")
+    parser.add_argument("--poll", action="store_true", help="Watch the hosts file by polling, as on MacOS.")
+    parser.add_argument("--start", type=datetime.datetime.fromisoformat, help="When the simulation starts.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-gap", type=float, default=None,
+                        help="Exit with an error if the websites were left open for longer than this, in seconds.")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    # Keep the daemon's logging out of the results.
+    scheduler.logger.setLevel(logging.WARNING)
+
+    report = simulate(
+        days=args.days,
+        conditions=args.conditions,
+        websites=args.websites,
+        success_rate=args.success_rate,
+        check_interval=args.check_interval,
+        attempts=args.unblock_attempts,
+        tampers=args.tampers,
+        poll=args.poll,
+        start=args.start,
+        seed=args.seed,
+    )
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.max_gap is not None and report["gap_seconds"] > args.max_gap:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
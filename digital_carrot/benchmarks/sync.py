@@ -0,0 +1,131 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from digital_carrot import annoying_scheduler as scheduler
+from digital_carrot.benchmarks.http_cache import StubServer, check
+from digital_carrot.benchmarks.scheduler import ALL_DAYS, blocklist, close_scheduler, make_scheduler, sandbox, write_hosts
+from digital_carrot.benchmarks.simulate import InlineExecutor
+
+# Checks fleet sync against a stub sync server on localhost. A scheduler in the
+# benchmark sandbox syncs for the first time from a snapshot, polls while nothing has
+# changed, and then picks up a new delta. Every poll's requests are checked, along with
+# what got merged. Prints the results as JSON and exits with an error if a check failed.
+
+
+# A file for StubServer. With an etag it is revalidated on every poll, like a manifest
+# that can change at any time.
+def json_file(data, etag=None):
+    body = json.dumps(data).encode("utf-8")
+    if etag is None:
+        return body, {"Content-Type": "application/json"}, None
+    headers = {"Content-Type": "application/json", "ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    return body, headers, {"ETag": f'"{etag}"'}
+
+
+def publish(server, version, snapshot, deltas):
+    server.files["/manifest.json"] = json_file({
+        "version": version,
+        "snapshot": {"version": snapshot, "url": f"full-{snapshot}.json"},
+        "deltas": [{"version": delta, "url": f"{delta}.json"} for delta in deltas],
+    }, etag=version)
+
+
+# Poll the stub server once, the way the sync timer does. Returns the paths requested.
+def poll(sched, server):
+    before = len(server.requests)
+    sched.start_sync()
+    sched.finish_syncs()
+    return [path for path, _ in server.requests[before:]]
+
+
+def run(websites=10000):
+    server = StubServer().start()
+    results = []
+    with sandbox() as root:
+        write_hosts(scheduler.HOSTS_FILE, 10)
+        script = os.path.join(root, "synced.sh")
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\nexit 0\n")
+        binary = os.path.join(root, "binary")
+        with open(binary, "wb") as f:
+            f.write(b"\x7fELF\xff\xfe\x00")
+
+        server.files["/full-1.json"] = json_file({"blocked_websites": blocklist(websites), "conditions": {}})
+        server.files["/2.json"] = json_file({"blocked_websites": ["two.example.com"], "conditions": {}})
+        publish(server, 2, 1, [2])
+
+        sched = make_scheduler(root, websites=["already.example.com"])
+        sched.config["sync_url"] = server.url + "/manifest.json"
+        sched.executor.shutdown()
+        sched.executor = InlineExecutor()
+        try:
+            paths = poll(sched, server)
+            blocked = sched.config["blocked_websites"]
+            results.append(check(
+                "first sync starts from the snapshot",
+                paths == ["/manifest.json", "/full-1.json", "/2.json"] and len(blocked) == websites + 2
+                and sched.config.get("sync_version") == 2,
+                requests=paths, blocked_websites=len(blocked),
+            ))
+
+            paths = poll(sched, server)
+            etag = server.requests[-1][1].get("If-None-Match")
+            results.append(check("an unchanged poll is a single 304", paths == ["/manifest.json"] and etag == '"2"',
+                                 requests=paths, if_none_match=etag))
+
+            server.files["/3.json"] = json_file({
+                "blocked_websites": ["three.example.com"],
+                "conditions": {
+                    "synced": {"script": script, "require_on": ALL_DAYS},
+                    "bad_timeout": {"script": script, "require_on": ALL_DAYS, "timeout": "60"},
+                    "bad_day": {"script": script, "require_on": ["monday"],
+                                "pause_condition": {"require_streak": 3}},
+                    # Valid, but their scripts can't be read.
+                    "directory": {"script": root, "require_on": ALL_DAYS},
+                    "binary": {"script": binary, "require_on": ALL_DAYS},
+                },
+            })
+            publish(server, 3, 1, [2, 3])
+            paths = poll(sched, server)
+            conditions = sorted(sched.config["conditions"])
+            results.append(check(
+                "only the new delta is downloaded",
+                paths == ["/manifest.json", "/3.json"] and "three.example.com" in sched.config["blocked_websites"],
+                requests=paths,
+            ))
+            results.append(check("invalid conditions are skipped", conditions == ["synced"], conditions=conditions))
+
+            message, met = sched.unblock()
+            results.append(check("unblock still works", met, message=message))
+        finally:
+            close_scheduler(sched)
+            server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check fleet sync against a stub sync server.")
+    parser.add_argument("--websites", type=int, default=10000, help="Size of the snapshot's block list.")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    # Keep the daemon's logging out of the results.
+    scheduler.logger.setLevel(logging.ERROR)
+
+    results = run(args.websites)
+    output = json.dumps({"results": results}, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import ipaddress
+import os
+import re
+
+# Parsers for community block lists. These are streamed line by line so that lists with
+# hundreds of thousands of entries never have to be held in memory more than once.
+#
+# The following formats are understood, and can be mixed in the same file:
+#   - hosts files: "0.0.0.0 example.com" (any address, any number of names)
+#   - adblock style domain rules: "||example.com^"
+#   - plain lists with one domain per line
+
+DOMAIN_RE = re.compile(r"^(?=.{1,253}$)(?!-)[a-z0-9_-]{1,63}(?<!-)(\.(?!-)[a-z0-9_-]{1,63}(?<!-))+$")
+
+# Names that show up in most hosts files but should never be blocked.
+IGNORED = {
+    "localhost",
+    "localhost.localdomain",
+    "local",
+    "broadcasthost",
+    "ip6-localhost",
+    "ip6-loopback",
+    "ip6-localnet",
+    "ip6-mcastprefix",
+    "ip6-allnodes",
+    "ip6-allrouters",
+    "ip6-allhosts",
+}
+
+
+def is_ip(value):
+    if value in ("0.0.0.0", "127.0.0.1", "::", "::1"):
+        return True
+    if not (value[-1].isdigit() or ":" in value):
+        return False
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
+# Returns the names listed on a single line.
+def parse_line(line):
+    line = line.strip()
+    if not line or line[0] in "#![" or line.startswith("@@"):
+        return []
+
+    if line.startswith("||"):
+        domain, sep, rest = line[2:].partition("^")
+        # Only plain domain rules. Anything matching paths or with extra conditions
+        # can't be enforced by blocking a domain.
+        if not sep or (rest and not rest.startswith("$")) or "domain=" in rest:
+            return []
+        return [domain]
+
+    fields = line.split("#", 1)[0].split()
+    if len(fields) > 1 and is_ip(fields[0]):
+        return fields[1:]
+    if len(fields) == 1:
+        return fields
+    return []
+
+
+# Lower case a name and check that it is a domain we can block. Returns None if it
+# isn't.
+def normalize(name):
+    name = name.strip().lower().rstrip(".")
+    if name.startswith("*."):
+        name = name[2:]
+    if not name.isascii():
+        try:
+            name = name.encode("idna").decode("ascii")
+        except UnicodeError:
+            return None
+    if not name or name in IGNORED or is_ip(name) or not DOMAIN_RE.match(name):
+        return None
+    return name
+
+
+def iter_files(path):
+    if not os.path.isdir(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.startswith("."):
+                yield os.path.join(root, name)
+
+
+# Stream every domain from the given files or directories.
+def iter_domains(paths):
+    for path in paths:
+        for filename in iter_files(path):
+            with open(filename, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    for name in parse_line(line):
+                        if domain := normalize(name):
+                            yield domain
+
+
+# Returns the unique domains from the given files or directories. Parent domains are
+# sorted before their subdomains, so that the daemon can drop subdomains that are
+# already covered by a parent as it reads the list.
+def load(paths):
+    return sorted(set(iter_domains(paths)), key=lambda domain: (domain.count("."), domain))
@@ -1,52 +1,108 @@
 import os
 import argparse
 import json
+import socket
+import struct
 
 from getpass import getpass
 
-from digital_carrot import assets
-from digital_carrot.config import Config
+# The CLI gets called from shell prompts and status bars, so most commands only use the
+# standard library. The config model (pydantic), the daemon module and the block list
+# parsers are imported by the commands that need them.
 
-from digital_carrot.annoying_scheduler import (
-    AnnoyingScheduler,
-    IN_PIPE,
-    OUT_PIPE,
-    hash
-)
-import dis
+# Must match COMMAND_SOCKET in annoying_scheduler.py, which has to stay standalone.
+WORKING_DIR = "/tmp/annoying_scheduler/"
+COMMAND_SOCKET = os.path.join(WORKING_DIR, "comms.sock")
 
-def send_cmd(cmd):
-    with open(IN_PIPE, "w") as pipe:
-        pipe.write(cmd)
 
-    with open(OUT_PIPE, "r") as pipe:
-        return pipe.read()
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The daemon closed the connection.")
+        data += chunk
+    return bytes(data)
+
+
+# Messages to and from the daemon are JSON, prefixed with their length.
+def send_frame(sock, msg):
+    data = json.dumps(msg).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def recv_frame(sock):
+    length = struct.unpack("!I", recv_exactly(sock, 4))[0]
+    return json.loads(recv_exactly(sock, length).decode("utf-8"))
+
+
+# If progress is given, the daemon streams a line for each condition as soon as it's
+# done, which progress gets called with, and the response only holds what's left.
+def send_cmd(cmd, *args, progress=None):
+    request = {"id": 1, "cmd": cmd, "args": list(args)}
+    if progress is not None:
+        request["stream"] = True
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(COMMAND_SOCKET)
+        send_frame(sock, request)
+        while "progress" in (resp := recv_frame(sock)):
+            progress(resp["progress"])
+
+    if "error" in resp:
+        return "Error: " + resp["error"]
+    return resp["result"]
 
 
 def absify_the_config(cfg):
-    for condition in cfg["conditions"]:
-        cfg["conditions"][condition]["script"] = os.path.abspath(cfg["conditions"][condition]["script"])
+    for condition in cfg["conditions"].values():
+        if condition.get("script"):
+            condition["script"] = os.path.abspath(condition["script"])
     return cfg
 
+def print_progress(line):
+    print(line, flush=True)
+
 def unblock(args):
-    print(send_cmd("unblock"))
+    print(send_cmd("unblock", args.fresh, progress=print_progress))
 
 
 def update_config(args):
+    from digital_carrot.config import Config
+
     with open(args.config[0], "r+") as f:
         cfg = json.loads(f.read())
+        Config.parse_obj(cfg)
         cfg = absify_the_config(cfg)
         f.seek(0)
         f.write(json.dumps(cfg, indent=4))
         f.truncate()
 
-    print(send_cmd("update:" + os.path.abspath(args.config[0])))
+    print(send_cmd("update", os.path.abspath(args.config[0])))
+
+
+def import_blocklist(args):
+    import tempfile
+    from digital_carrot import blocklist
+
+    domains = blocklist.load(args.path)
+
+    # Hand the list to the daemon as a file, so that it can stream it.
+    with tempfile.NamedTemporaryFile("w", prefix="digital_carrot_", suffix=".txt") as f:
+        for domain in domains:
+            f.write(domain + "\n")
+        f.flush()
+        os.chmod(f.name, 0o644)
+        print(f"Read {len(domains)} websites.")
+        print(send_cmd("import", f.name))
 
 
 def pause(args):
-    print(send_cmd("pause:" + args.days + ":" + args.condition))
+    print(send_cmd("pause", args.days, args.condition, progress=print_progress))
 
 def init(args):
+    from digital_carrot import assets
+
     files = {
         "instructions.md": assets.INSTRUCTIONS,
         "config.json": assets.JSON_CONFIG_TEMPLATE,
@@ -62,7 +118,32 @@ def init(args):
 def purge(args):
     print(send_cmd("purge"))
 
+def stats(args):
+    print(send_cmd("stats"), end="")
+
+def streak(args):
+    print(send_cmd("streak", args.condition))
+
+def rate(args):
+    print(send_cmd("rate", args.condition, args.days))
+
+def latency(args):
+    print(send_cmd("latency", args.condition, args.weeks))
+
+def logs(args):
+    print(send_cmd("logs", args.lines))
+
+def profile(args):
+    print(send_cmd("profile", args.seconds))
+
+def stacks(args):
+    print(send_cmd("stacks"))
+
 def start(args):
+    from digital_carrot.config import Config
+    from digital_carrot.annoying_scheduler import AnnoyingScheduler, hash, setup_logging
+
+    setup_logging()
     if args.config:
         cfg = Config.parse_file(args.config)
 
@@ -77,6 +158,9 @@ def start(args):
 
             sched_cfg = absify_the_config(cfg.dict(exclude_none=True))
             sched_cfg["hashed_password"] = hash(pw)
+            # Don't run the condition scripts as root unless asked to.
+            if "run_as" not in sched_cfg and (user := os.environ.get("SUDO_USER")):
+                sched_cfg["run_as"] = user
         else:
             print("ya gotta use a password for now")
             exit()
@@ -90,7 +174,7 @@ def start(args):
 def disable(args):
     print(send_cmd("disable_challenge"))
     response = getpass("Enter response: ")
-    print(send_cmd("disable:" + response))
+    print(send_cmd("disable", response))
 
 
 def get_parser():
@@ -99,11 +183,19 @@ def get_parser():
 
     parse_unblock(subparsers)
     parse_update_config(subparsers)
+    parse_import(subparsers)
     parse_pause(subparsers)
     parse_init(subparsers)
     parse_start(subparsers)
     parse_disable(subparsers)
     parse_purge_failing(subparsers)
+    parse_stats(subparsers)
+    parse_logs(subparsers)
+    parse_profile(subparsers)
+    parse_stacks(subparsers)
+    parse_streak(subparsers)
+    parse_rate(subparsers)
+    parse_latency(subparsers)
 
     return parser
 
@@ -111,6 +203,41 @@ def parse_purge_failing(subparsers):
     parser = subparsers.add_parser('purge', help='Remove any conditions that are broken or have never returned a success.')
     parser.set_defaults(func=purge)
 
+def parse_stats(subparsers):
+    parser = subparsers.add_parser('stats', help='Show what the daemon has been spending its time on.')
+    parser.set_defaults(func=stats)
+
+def parse_streak(subparsers):
+    parser = subparsers.add_parser('streak', help='Show how many required days in a row each condition has been met.')
+    parser.add_argument('condition', nargs='?', help='Only show this condition.')
+    parser.set_defaults(func=streak)
+
+def parse_rate(subparsers):
+    parser = subparsers.add_parser('rate', help='Show how often each condition has been met on the days it was required.')
+    parser.add_argument('condition', nargs='?', help='Only show this condition.')
+    parser.add_argument('--days', type=int, default=30, help='Number of days to look back.')
+    parser.set_defaults(func=rate)
+
+def parse_latency(subparsers):
+    parser = subparsers.add_parser('latency', help='Show how long each condition has been taking to check, by week.')
+    parser.add_argument('condition', nargs='?', help='Only show this condition.')
+    parser.add_argument('--weeks', type=int, default=12, help='Number of weeks to look back.')
+    parser.set_defaults(func=latency)
+
+def parse_logs(subparsers):
+    parser = subparsers.add_parser('logs', help="Show the daemon's most recent log messages.")
+    parser.add_argument('-n', '--lines', type=int, default=50, help='Number of lines to show.')
+    parser.set_defaults(func=logs)
+
+def parse_profile(subparsers):
+    parser = subparsers.add_parser('profile', help="Profile the daemon's CPU and memory use for a while.")
+    parser.add_argument('seconds', type=float, nargs="?", default=30, help='How long to profile for.')
+    parser.set_defaults(func=profile)
+
+def parse_stacks(subparsers):
+    parser = subparsers.add_parser('stacks', help="Show what every thread in the daemon is doing.")
+    parser.set_defaults(func=stacks)
+
 def parse_start(subparsers):
     parser = subparsers.add_parser('start', help='Start digital-carrot.')
     parser.add_argument('config', nargs="?", help='Path to the config file that you wish to use to launch.')
@@ -126,6 +253,8 @@ def parse_disable(subparsers):
 
 def parse_unblock(subparsers):
     parser = subparsers.add_parser('unblock', help='Request to unblock your laptop.')
+    parser.add_argument('--fresh', action='store_true',
+                        help='Check every condition again instead of using results from the background.')
     parser.set_defaults(func=unblock)
 
 def parse_update_config(subparsers):
@@ -136,6 +265,14 @@ def parse_update_config(subparsers):
     parser.add_argument('config', nargs=1, help='Path to the config file that you wish to use to launch.')
     parser.set_defaults(func=update_config)
 
+def parse_import(subparsers):
+    parser = subparsers.add_parser(
+        'import',
+        help='Block every website in a hosts file, adblock list or list of domains. Directories are read recursively.'
+    )
+    parser.add_argument('path', nargs='+', help='Files or directories to import.')
+    parser.set_defaults(func=import_blocklist)
+
 
 def parse_pause(subparsers):
     parser = subparsers.add_parser(
@@ -6,6 +6,28 @@ from typing import Optional
 class DisableMethod(str, Enum):
     PASSWORD = "password"
 
+class EnforcementBackend(str, Enum):
+    HOSTS = "hosts"
+    DNS = "dns"
+
+class ServiceBackend(str, Enum):
+    AUTO = "auto"
+    LAUNCHD = "launchd"
+    SYSTEMD = "systemd"
+    SUPERVISOR = "supervisor"
+
+class ConditionType(str, Enum):
+    SCRIPT = "script"
+    HTTP_JSON_THRESHOLD = "http_json_threshold"
+
+class Comparison(str, Enum):
+    GE = ">="
+    GT = ">"
+    LE = "<="
+    LT = "<"
+    EQ = "=="
+    NE = "!="
+
 class WeekDay(str, Enum):
     MONDAY = "mon"
     TUESDAY = "tue"
@@ -19,14 +41,44 @@ class WeekDay(str, Enum):
 class PauseCondition(BaseModel):
     max_pause_days: Optional[int] = None
     pause_args: list[str] = []
-    # require_streak: int
+    # The condition has to have been met this many required days in a row before it can
+    # be paused.
+    require_streak: Optional[int] = None
 
 
 class Condition(PauseCondition):
     require_on: list[WeekDay]
-    script: str
+    type: ConditionType = Field(default=ConditionType.SCRIPT)
+    script: Optional[str] = None
     args: list[str] = Field(default=[])
-    # internal_script: Optional[str] = None
+    # Seconds before the script is killed and counted as not met.
+    timeout: int = Field(default=60)
+    # Results are reused instead of running the script again. Successes are kept
+    # until 2am (or cache_ttl seconds if set), failures for failure_cache_ttl seconds.
+    cache_ttl: Optional[int] = None
+    failure_cache_ttl: int = Field(default=30)
+    # Run the condition in the background every check_interval seconds until it is met,
+    # so that 'unblock' can answer straight away. Websites are unblocked as soon as all
+    # conditions are met.
+    check_interval: Optional[int] = None
+    # Settings of the built in condition types. http_json_threshold fetches JSON from
+    # url and compares the number at json_path (e.g. "data.0.steps") with the first
+    # argument, or threshold if there are no arguments.
+    url: Optional[str] = None
+    headers: dict[str, str] = Field(default={})
+    json_path: Optional[str] = None
+    threshold: Optional[float] = None
+    comparison: Comparison = Field(default=Comparison.GE)
+    # Scripts run as run_as (Config.run_as if not set) in their own process group, with
+    # at most cpu_limit seconds of CPU time (the timeout if not set), memory_limit MB of
+    # address space and open_files_limit open files. Output past output_limit bytes is
+    # thrown away.
+    run_as: Optional[str] = None
+    cpu_limit: Optional[int] = None
+    memory_limit: Optional[int] = None
+    open_files_limit: int = Field(default=256)
+    output_limit: int = Field(default=1024 * 1024)
+    # script_sha: Optional[str] = None
     pause_condition: Optional[PauseCondition] = None
     # pause_until: Optional[str] = None
 
@@ -36,6 +88,25 @@ class Config(BaseModel):
     blocked_websites: list[str]
     conditions: dict[str, Condition]
     disable_method: DisableMethod = Field(default=DisableMethod.PASSWORD)
+    enforcement_backend: EnforcementBackend = Field(default=EnforcementBackend.HOSTS)
+    dns_listen: str = Field(default="127.0.0.1:53")
+    dns_upstream: str = Field(default="1.1.1.1:53")
+    metrics_textfile: Optional[str] = None
+    # How the daemon keeps itself running. "auto" uses launchd on MacOS and systemd on
+    # Linux, or its own supervisor process if systemd isn't running.
+    service_backend: ServiceBackend = Field(default=ServiceBackend.AUTO)
+    # Run python condition scripts in forks of a warm interpreter that already has
+    # these modules imported.
+    python_worker_pool: bool = Field(default=False)
+    preload_modules: list[str] = Field(default=["requests"])
+    # Poll this URL every sync_interval seconds for websites and conditions to add, as
+    # if they had been added with 'digital-carrot update'.
+    sync_url: Optional[str] = None
+    sync_headers: dict[str, str] = Field(default={})
+    sync_interval: int = Field(default=300)
+    # The user that condition scripts run as. 'digital-carrot start' fills in the user
+    # that ran sudo. Set it to "root" to run them as root.
+    run_as: Optional[str] = None
 
     # Internal
     # pause_until: Optional[str] = None